@@ -0,0 +1,56 @@
+'''
+Compares the vectorized frame decoding in wif.reading against
+the original per-pixel loop.
+
+    $ python benchmarks/frame_decoding.py --width 1920 --height 1080
+'''
+import argparse
+import os
+import struct
+import timeit
+from PIL import Image
+import wif.reading
+
+
+def create_frame(width, height):
+    return struct.pack('<2I', width, height) + os.urandom(width * height * 3)
+
+
+def legacy_frame_to_image(frame):
+    width, height = struct.unpack('<2I', frame[:8])
+    pixels = list(struct.iter_unpack("3B", frame[8:]))
+    image = Image.new('RGB', (width, height))
+    image_buffer = image.load()
+    for y in range(height):
+        for x in range(width):
+            i = y * width + x
+            image_buffer[x, y] = pixels[i]
+    return image
+
+
+def measure(function, frame, repeat):
+    return min(timeit.repeat(lambda: function(frame), number=1, repeat=repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    frame = create_frame(args.width, args.height)
+    assert legacy_frame_to_image(frame).tobytes() == wif.reading.frame_to_image(frame).tobytes()
+
+    legacy = measure(legacy_frame_to_image, frame, args.repeat)
+    vectorized = measure(wif.reading.frame_to_image, frame, args.repeat)
+    array = measure(wif.reading.frame_to_array, frame, args.repeat)
+
+    print(f'Frame size {args.width}x{args.height}')
+    print(f'per-pixel loop   {legacy * 1000:10.2f} ms')
+    print(f'frame_to_image   {vectorized * 1000:10.2f} ms ({legacy / vectorized:.0f}x)')
+    print(f'frame_to_array   {array * 1000:10.2f} ms ({legacy / array:.0f}x)')
+
+
+if __name__ == '__main__':
+    main()
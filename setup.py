@@ -22,7 +22,8 @@ setup(
     license='MIT',
     packages=['wif', 'wif.gui'],
     entry_points={
-          'console_scripts': ['wif=wif.main:main']
+          'console_scripts': ['wif=wif.main:main',
+                              'wif-stub-raytracer=wif.stub:main']
     },
     install_requires=['pillow', 'numpy', 'opencv-contrib-python'],
     zip_safe=False)
@@ -0,0 +1,136 @@
+'''
+Converts many files at once with a pool of worker processes,
+so that the cost of starting Python and importing cv2 and PIL is only paid once per worker.
+
+    $ wif movie renders/*.chai movies/
+    $ wif convert scenes/ 'out/{stem}.wif2'
+
+Inputs can be files, glob patterns or directories. The output is either a pattern
+in which {stem} is replaced by the name of the input without its extension,
+or a directory. Outputs that are newer than their input are skipped.
+'''
+from collections import namedtuple
+import concurrent.futures
+import glob
+import os
+import time
+import wif.config
+
+
+INPUT_EXTENSIONS = ('.chai', '.wif', '.wif2')
+STEM = '{stem}'
+
+
+Conversion = namedtuple('Conversion', ['input', 'output'])
+
+
+def _is_pattern(path):
+    return any(character in path for character in '*?[')
+
+
+def is_batch(inputs, output):
+    '''
+    Tells whether the inputs and output ask for a batch conversion
+    rather than converting a single file.
+    '''
+    return len(inputs) > 1 or \
+        any(_is_pattern(input) or os.path.isdir(input) for input in inputs) or \
+        STEM in output or \
+        os.path.isdir(output)
+
+
+def expand_inputs(inputs):
+    '''
+    Turns files, glob patterns and directories into a list of files, without duplicates.
+    Patterns and directories only contribute files with one of the INPUT_EXTENSIONS.
+    '''
+    def is_input(path):
+        return os.path.isfile(path) and path.endswith(INPUT_EXTENSIONS)
+
+    files = []
+    for input in inputs:
+        if os.path.isdir(input):
+            files += sorted(path for path in (os.path.join(input, name) for name in os.listdir(input))
+                            if is_input(path))
+        elif _is_pattern(input):
+            files += sorted(path for path in glob.glob(input) if is_input(path))
+        else:
+            files.append(input)
+    return list(dict.fromkeys(files))
+
+
+def output_path(input, output, extension):
+    '''
+    Returns where to write the conversion of input. An output without {stem}
+    is a directory, in which case the output gets the given extension.
+    '''
+    stem = os.path.splitext(os.path.basename(input))[0]
+    if STEM in output:
+        return output.replace(STEM, stem)
+    else:
+        return os.path.join(output, f'{stem}.{extension}')
+
+
+def is_up_to_date(input, output):
+    return os.path.exists(output) and os.path.getmtime(output) >= os.path.getmtime(input)
+
+
+def plan(inputs, output, extension, force=False):
+    '''
+    Returns the conversions to perform and the ones that can be skipped
+    because their output is newer than their input. With force, nothing is skipped.
+    '''
+    conversions = []
+    skipped = []
+    for input in expand_inputs(inputs):
+        conversion = Conversion(input, output_path(input, output, extension))
+        if not force and os.path.exists(input) and is_up_to_date(*conversion):
+            skipped.append(conversion)
+        else:
+            conversions.append(conversion)
+    return (conversions, skipped)
+
+
+def _perform(convert, conversion):
+    '''
+    Runs in a worker process. Returns how long the conversion took.
+    A conversion that writes no output, e.g., because its input holds no frames, fails.
+    '''
+    start = time.perf_counter()
+    directory = os.path.dirname(conversion.output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    convert(*conversion)
+    if not os.path.exists(conversion.output):
+        raise ValueError(f'No output was written to {conversion.output}')
+    return time.perf_counter() - start
+
+
+def run(convert, conversions, processes=None, report=None):
+    '''
+    Calls convert(input, output) for each conversion in a pool of processes.
+    convert must be picklable, e.g., a module level function.
+    A value of 0 for processes means one process per core.
+    After each conversion, report is called with the conversion,
+    the number of seconds it took and the error it raised, if any.
+    Returns a list of (conversion, error) pairs for the conversions that failed.
+    '''
+    if processes is None:
+        processes = wif.config.configuration['batch_processes']
+    processes = min(processes or os.cpu_count(), len(conversions)) or 1
+
+    failures = []
+    with concurrent.futures.ProcessPoolExecutor(processes, initializer=wif.config.init) as executor:
+        futures = {executor.submit(_perform, convert, conversion): conversion for conversion in conversions}
+        for future in concurrent.futures.as_completed(futures):
+            conversion = futures[future]
+            try:
+                seconds = future.result()
+                error = None
+            except Exception as exception:
+                seconds = None
+                error = exception
+                failures.append((conversion, error))
+            if report:
+                report(conversion, seconds, error)
+    return failures
@@ -0,0 +1,221 @@
+'''
+Measures the throughput of the wif pipeline on synthetic data,
+so that releases can be compared without the raytracer or real scenes.
+
+    $ wif bench --sizes 320x240 1920x1080 --frame-counts 60 --output results.json
+
+Each benchmark runs in a fresh process, so that its peak memory use
+is not influenced by the benchmarks that ran before it.
+The convert benchmark renders with the stub raytracer, see wif.stub.
+'''
+import concurrent.futures
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import numpy
+import wif.config
+import wif.encoding
+import wif.raytracer
+import wif.reading
+from wif.version import __version__
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+def create_synthetic_frame(index, width, height):
+    '''
+    Creates a frame with a moving gradient, which unlike a flat color
+    gives image and movie encoders some work to do.
+    '''
+    x = numpy.arange(width, dtype=numpy.uint32)
+    y = numpy.arange(height, dtype=numpy.uint32)[:, numpy.newaxis]
+    pixels = numpy.empty((height, width, 3), dtype=numpy.uint8)
+    pixels[:, :, 0] = (x + index) % 256
+    pixels[:, :, 1] = (y + 2 * index) % 256
+    pixels[:, :, 2] = (x + y) % 256
+    return numpy.array([width, height], dtype='<u4').tobytes() + pixels.tobytes()
+
+
+def create_synthetic_wif(path, width, height, frame_count):
+    frames = (create_synthetic_frame(index, width, height) for index in range(frame_count))
+    wif.encoding.create_wif(frames, path)
+
+
+def _stub_script(case):
+    return (f'stub_frame_count = {case["frame_count"]};\n'
+            f'stub_width = {case["width"]};\n'
+            f'stub_height = {case["height"]};\n'
+            f'stub_frame_rate = {case["rate"]};\n')
+
+
+def _timed(items, timestamps):
+    '''
+    Records when each item becomes available.
+    '''
+    for item in items:
+        timestamps.append(time.perf_counter())
+        yield item
+
+
+def _consume(items):
+    '''
+    Exhausts items and returns the time at which each of them arrived,
+    preceded by the time at which the benchmark started.
+    '''
+    timestamps = [time.perf_counter()]
+    for _ in _timed(items, timestamps):
+        pass
+    return timestamps
+
+
+def _encode(arrays, case):
+    '''
+    Returns timestamps like _consume. The encoder taking the next frame
+    is taken to mean it is done with the previous one.
+    '''
+    start = time.perf_counter()
+    timestamps = []
+    wif.encoding.create_mp4(_timed(arrays, timestamps), case['movie'], codec=case['codec'])
+    return [start] + timestamps[1:] + [time.perf_counter()]
+
+
+def _bench_read_frames(case):
+    return _consume(wif.reading.read_frames(wif.reading.read_blocks_from_file(case['path'])))
+
+
+def _bench_frame_to_image(case):
+    frames = list(wif.reading.read_frames_from_file(case['path']))
+    return _consume(map(wif.reading.frame_to_image, frames))
+
+
+def _bench_read_arrays(case):
+    return _consume(wif.reading.read_arrays_from_file(case['path'], workers=case['workers']))
+
+
+def _bench_read_images(case):
+    return _consume(wif.reading.read_images(wif.reading.read_blocks_from_file(case['path']), workers=case['workers']))
+
+
+def _bench_create_mp4(case):
+    arrays = list(wif.reading.read_arrays_from_file(case['path']))
+    return _encode(arrays, case)
+
+
+def _bench_convert(case):
+    '''
+    Renders a script with the stub raytracer and encodes it into a movie, like wif convert does.
+    '''
+    def arrays():
+        blocks, _ = wif.raytracer.invoke_raytracer(_stub_script(case), ignore_messages=True, use_cache=False)
+        yield from wif.reading.read_arrays(blocks)
+
+    return _encode(arrays(), case)
+
+
+BENCHMARKS = {
+    'read_frames': _bench_read_frames,
+    'frame_to_image': _bench_frame_to_image,
+    'read_arrays': _bench_read_arrays,
+    'read_images': _bench_read_images,
+    'create_mp4': _bench_create_mp4,
+    'convert': _bench_convert,
+}
+
+
+def _peak_rss():
+    '''
+    Returns the peak resident set size of this process in bytes.
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _run_benchmark(name, case):
+    '''
+    Runs in a process of its own.
+    '''
+    wif.config.configuration['block_size'] = case['block_size']
+    wif.config.configuration['raytracer'] = case['raytracer']
+    timestamps = BENCHMARKS[name](case)
+    latencies = numpy.diff(timestamps)
+    frame_count = len(latencies)
+    seconds = timestamps[-1] - timestamps[0]
+    frame_bytes = 8 + case['width'] * case['height'] * 3
+    return {
+        'benchmark': name,
+        'width': case['width'],
+        'height': case['height'],
+        'frame_count': frame_count,
+        'block_size': case['block_size'],
+        'seconds': seconds,
+        'frames_per_second': frame_count / seconds if seconds else None,
+        'megabytes_per_second': frame_count * frame_bytes / seconds / 1e6 if seconds else None,
+        'latency': {
+            'mean': float(latencies.mean()) if len(latencies) else None,
+            'p95': float(numpy.percentile(latencies, 95)) if len(latencies) else None,
+            'max': float(latencies.max()) if len(latencies) else None,
+        },
+        'peak_rss': _peak_rss(),
+    }
+
+
+def _stub_raytracer():
+    return shutil.which('wif-stub-raytracer')
+
+
+def run_benchmarks(names, sizes, frame_counts, block_sizes, rate=0, workers=1, codec='mp4v', report=None):
+    '''
+    Runs the named benchmarks for every combination of frame size, frame count and block size.
+    Sizes are (width, height) pairs. Calls report with the result of each benchmark.
+    Returns a dictionary with all results, ready to be written as JSON.
+    '''
+    raytracer = _stub_raytracer()
+    if 'convert' in names and raytracer is None:
+        raise ValueError('The convert benchmark needs wif-stub-raytracer to be installed')
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as directory:
+        for width, height in sizes:
+            for frame_count in frame_counts:
+                path = os.path.join(directory, f'{width}x{height}x{frame_count}.wif')
+                create_synthetic_wif(path, width, height, frame_count)
+                for block_size in block_sizes:
+                    case = {
+                        'path': path,
+                        'movie': os.path.join(directory, 'movie.mp4'),
+                        'width': width,
+                        'height': height,
+                        'frame_count': frame_count,
+                        'block_size': block_size,
+                        'rate': rate,
+                        'workers': workers,
+                        'codec': codec,
+                        'raytracer': raytracer,
+                    }
+                    for name in names:
+                        with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+                            result = executor.submit(_run_benchmark, name, case).result()
+                        results.append(result)
+                        if report:
+                            report(result)
+                os.remove(path)
+
+    return {
+        'version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }
@@ -0,0 +1,223 @@
+'''
+Keeps the output of raytracer runs on disk, so that rendering
+an unchanged script with an unchanged raytracer is replayed instead.
+
+Entries are named after a hash of the script, the raytracer binary
+and the rendering options. Each entry consists of the WIF output
+and, if it was captured, a log of the raytracer's messages.
+When the cache grows beyond its configured size, the least recently
+used entries are evicted.
+'''
+from pathlib import Path
+from threading import Lock
+import contextlib
+import hashlib
+import os
+import tempfile
+import wif.config
+import wif.reading
+
+
+_output_extension = '.wif'
+_log_extension = '.log'
+_partial_extension = '.partial'
+
+
+def get_cache_directory():
+    directory = wif.config.configuration['cache_directory']
+    if directory:
+        return Path(directory)
+    else:
+        return Path.home() / '.wif' / 'cache'
+
+
+def is_enabled():
+    return wif.config.configuration['cache_size'] > 0
+
+
+def cache_key(script, raytracer, jobs=1):
+    '''
+    Identifies a rendering. The raytracer binary is identified by
+    its path, size and modification time rather than by its contents,
+    which would take too long to hash on every render.
+    '''
+    status = os.stat(raytracer)
+    hash = hashlib.sha256()
+    for part in (script, os.path.abspath(raytracer), status.st_size, status.st_mtime_ns, jobs):
+        hash.update(str(part).encode('utf-8'))
+        hash.update(b'\0')
+    return hash.hexdigest()
+
+
+def _output_path(key):
+    return get_cache_directory() / (key + _output_extension)
+
+
+def _log_path(key):
+    return get_cache_directory() / (key + _log_extension)
+
+
+def _read_log(path):
+    with open(path) as file:
+        yield from file
+
+
+def replay(key, ignore_messages=False):
+    '''
+    Returns (blocks, messages) of a cached rendering, or None if it is not in the cache.
+    '''
+    output = _output_path(key)
+    log = _log_path(key)
+    if not output.exists() or (not ignore_messages and not log.exists()):
+        return None
+
+    # Marks the entry as recently used
+    for path in (output, log):
+        if path.exists():
+            os.utime(path)
+
+    blocks = wif.reading.read_blocks_from_file(output)
+    messages = None if ignore_messages else _read_log(log)
+    return (blocks, messages)
+
+
+class _Recording:
+    '''
+    Writes blocks and messages to the cache as they pass by.
+    The entry is only added once both have been received completely.
+    Each recording writes to files of its own, created once recording starts,
+    so that recordings of the same key can run at the same time.
+    '''
+    def __init__(self, key, record_messages):
+        directory = get_cache_directory()
+        directory.mkdir(parents=True, exist_ok=True)
+        self.__key = key
+        self.__lock = Lock()
+        self.__remaining = 2 if record_messages else 1
+        self.__failed = False
+        # Maps the extensions of the entry's files to the partial files they are recorded in
+        self.__partials = {}
+
+    def record_blocks(self, blocks):
+        yield from self.__record(blocks, _output_extension, 'wb')
+
+    def record_messages(self, messages):
+        yield from self.__record(messages, _log_extension, 'w')
+
+    def __record(self, items, extension, mode):
+        partial = _create_partial(self.__key + extension)
+        with self.__lock:
+            self.__partials[extension] = partial
+        try:
+            with open(partial, mode) as file:
+                for item in items:
+                    file.write(item)
+                    yield item
+        except BaseException:
+            # Also covers the receiver losing interest. The other file might never
+            # be finished, so this one is removed right away.
+            _remove(partial)
+            self.__finish(failed=True)
+            raise
+        self.__finish(failed=False)
+
+    def __finish(self, failed):
+        with self.__lock:
+            self.__failed = self.__failed or failed
+            self.__remaining -= 1
+            if self.__remaining > 0:
+                return
+        for extension, partial in self.__partials.items():
+            if self.__failed:
+                _remove(partial)
+            else:
+                os.replace(partial, get_cache_directory() / (self.__key + extension))
+        if not self.__failed:
+            evict()
+
+
+def _remove(path):
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(path)
+
+
+def _create_partial(name):
+    '''
+    Creates a new file in the cache directory to record an entry's file into, and returns its path.
+    '''
+    handle, path = tempfile.mkstemp(prefix=name + '.', suffix=_partial_extension, dir=get_cache_directory())
+    os.close(handle)
+    return path
+
+
+def record(key, blocks, messages):
+    '''
+    Wraps the blocks and messages of a rendering so that they get added to the cache.
+    '''
+    recording = _Recording(key, messages is not None)
+    blocks = recording.record_blocks(blocks)
+    messages = None if messages is None else recording.record_messages(messages)
+    return (blocks, messages)
+
+
+def _entries():
+    '''
+    Returns a dictionary mapping keys to the files of their entry.
+    '''
+    entries = {}
+    directory = get_cache_directory()
+    if directory.exists():
+        for path in directory.iterdir():
+            if path.suffix in (_output_extension, _log_extension):
+                entries.setdefault(path.stem, []).append(path)
+    return entries
+
+
+def _stats(files):
+    '''
+    Returns the stat of each file that still exists, as other processes
+    sharing the cache can remove entries at any time.
+    '''
+    stats = []
+    for path in files:
+        with contextlib.suppress(FileNotFoundError):
+            stats.append(path.stat())
+    return stats
+
+
+def _last_used(files):
+    return max((stat.st_mtime for stat in _stats(files)), default=0)
+
+
+def _size(files):
+    return sum(stat.st_size for stat in _stats(files))
+
+
+def evict():
+    '''
+    Removes the least recently used entries until the cache fits its configured size.
+    '''
+    entries = sorted(_entries().values(), key=_last_used)
+    total = sum(_size(files) for files in entries)
+    limit = wif.config.configuration['cache_size']
+    while entries and total > limit:
+        files = entries.pop(0)
+        total -= _size(files)
+        for path in files:
+            _remove(path)
+
+
+def statistics():
+    entries = _entries().values()
+    return {
+        'directory': str(get_cache_directory()),
+        'entries': len(entries),
+        'size': sum(_size(files) for files in entries),
+        'limit': wif.config.configuration['cache_size'],
+    }
+
+
+def clear():
+    for files in _entries().values():
+        for path in files:
+            _remove(path)
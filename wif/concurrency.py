@@ -1,58 +1,213 @@
-from queue import Queue
+from collections import deque
 import asyncio
-from threading import Thread
+from threading import Condition, Lock, Thread
 
 
-class Channel:
-    def __init__(self):
-        self.__queue = Queue()
-        self.__closed = False
+_background_loop = None
+_background_loop_lock = Lock()
+
+
+class ChannelClosed(Exception):
+    pass
 
-    def send(self, item):
-        self.__queue.put(item)
 
-    def receive(self):
-        return self.__queue.get()
+class Channel:
+    '''
+    Passes items from producers to consumers, which can be threads or coroutines.
+    A channel with a capacity makes senders wait while it is full,
+    so that a fast producer cannot run arbitrarily far ahead of its consumers.
+    '''
+    def __init__(self, capacity=None):
+        self.__items = deque()
+        self.__capacity = capacity
+        self.__condition = Condition()
+        self.__waiters = []
+        self.__closed = False
+        self.__error = None
+
+    def send(self, item, timeout=None):
+        '''
+        Adds an item, waiting for room if the channel is full.
+        Raises ChannelClosed if the channel has been closed
+        and TimeoutError if no room was made in time.
+        '''
+        with self.__condition:
+            if not self.__condition.wait_for(self.__can_send, timeout):
+                raise TimeoutError()
+            self.__put(item)
+
+    def receive(self, timeout=None):
+        '''
+        Removes the oldest item, waiting for one if the channel is empty.
+        Once a closed channel has been emptied, raises the error it was
+        closed with, or ChannelClosed if there was none.
+        Raises TimeoutError if no item arrived in time.
+        '''
+        with self.__condition:
+            if not self.__condition.wait_for(self.__can_receive, timeout):
+                raise TimeoutError()
+            return self.__take()
+
+    async def send_async(self, item):
+        '''
+        Like send, but waits without blocking the event loop.
+        '''
+        while True:
+            with self.__condition:
+                if self.__can_send():
+                    self.__put(item)
+                    return
+                waiter = self.__create_waiter()
+            await waiter
+
+    async def receive_async(self):
+        '''
+        Like receive, but waits without blocking the event loop.
+        '''
+        while True:
+            with self.__condition:
+                if self.__can_receive():
+                    return self.__take()
+                waiter = self.__create_waiter()
+            await waiter
 
     @property
     def empty(self):
-        return self.__queue.empty()
+        with self.__condition:
+            return not self.__items
+
+    def close(self, error=None):
+        '''
+        Closes the channel. Items already sent can still be received.
+        An error is raised by receive once the channel has been emptied.
+        Closing a channel that has already been closed has no effect.
+        '''
+        with self.__condition:
+            if self.__closed:
+                return
+            self.__closed = True
+            self.__error = error
+            self.__notify()
 
-    def close(self):
-        self.__closed = True
+    @property
+    def error(self):
+        return self.__error
 
     @property
     def finished(self):
-        return self.__closed and self.empty
+        with self.__condition:
+            return self.__closed and not self.__items
 
     @property
     def items(self):
-        while not self.finished:
-            while not self.empty:
+        while True:
+            try:
                 yield self.receive()
-
-
-def run_in_background(func):
-    Thread(target=func).start()
+            except ChannelClosed:
+                return
+
+    def __iter__(self):
+        return self.items
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.receive_async()
+        except ChannelClosed:
+            raise StopAsyncIteration
+
+    def __can_send(self):
+        return self.__closed or self.__capacity is None or len(self.__items) < self.__capacity
+
+    def __can_receive(self):
+        return self.__closed or self.__items
+
+    def __put(self, item):
+        if self.__closed:
+            raise ChannelClosed()
+        self.__items.append(item)
+        self.__notify()
+
+    def __take(self):
+        if self.__items:
+            item = self.__items.popleft()
+            self.__notify()
+            return item
+        raise self.__error or ChannelClosed()
+
+    def __create_waiter(self):
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self.__waiters.append((loop, waiter))
+        return waiter
+
+    def __notify(self):
+        '''
+        Wakes up all waiting threads and coroutines so they can check the channel again.
+        '''
+        self.__condition.notify_all()
+        for loop, waiter in self.__waiters:
+            loop.call_soon_threadsafe(_wake_up, waiter)
+        self.__waiters.clear()
+
+
+def _wake_up(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+def run_in_background(func, daemon=False):
+    Thread(target=func, daemon=daemon).start()
+
+
+def get_background_loop():
+    '''
+    Returns an event loop running on a thread of its own.
+    It is shared by all coroutines run in the background.
+    '''
+    global _background_loop
+    with _background_loop_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            run_in_background(_background_loop.run_forever, daemon=True)
+        return _background_loop
 
 
 def run_coroutine_in_background(coroutine):
-    loop = asyncio.new_event_loop()
+    '''
+    Schedules a coroutine on the background event loop.
+    Returns a concurrent.futures.Future for its result.
+    '''
+    return asyncio.run_coroutine_threadsafe(coroutine, get_background_loop())
+
+
+def generate_in_background(generator, capacity=None):
+    '''
+    Runs a generator on a separate thread and returns the channel its items are sent to.
+    With a capacity, the generator is paused while the channel is full.
+    Errors raised by the generator are passed on to the receiver.
+    Closing the channel stops the generator.
+    '''
+    channel = Channel(capacity)
 
     def threadproc():
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(coroutine)
-
-    Thread(target=threadproc).start()
-
-
-def generate_in_background(generator):
-    channel = Channel()
-
-    def threadproc():
-        for item in generator:
-            channel.send(item)
-        channel.close()
-
-    run_in_background(threadproc)
+        try:
+            for item in generator:
+                channel.send(item)
+        except ChannelClosed:
+            # Nobody is interested in the remaining items
+            pass
+        except Exception as error:
+            channel.close(error)
+        else:
+            channel.close()
+        finally:
+            close = getattr(generator, 'close', None)
+            if close:
+                close()
+
+    # Nothing is left to receive the items once the program is exiting
+    run_in_background(threadproc, daemon=True)
     return channel
@@ -10,6 +10,15 @@ CONFIG_FILENAME = 'wifcfg.json'
 configuration = {
     'raytracer': None,
     'block_size': 500000,
+    'workers': 1,
+    'frames_in_flight': 0,
+    'cache_size': 2 * 1024 ** 3,
+    'cache_directory': None,
+    'frame_store_budget': 1024 ** 3,
+    'frame_store_compression': False,
+    'message_line_limit': 10000,
+    'render_limit': 2,
+    'batch_processes': 0,
 }
 
 
@@ -33,10 +42,10 @@ def write():
 
 
 def _load_configuration():
-    global configuration
     path = get_configuration_path()
     with open(path) as file:
-        configuration = json.load(file)
+        # Update in place so that settings missing from older files keep their default
+        configuration.update(json.load(file))
 
 
 def _create_configuration_file():
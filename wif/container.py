@@ -0,0 +1,278 @@
+'''
+WIF2 is a binary container for frames. Its layout is
+
+    header   magic version:u16 reserved:u16
+    record*  kind:u8 length:u64 frame_size:u64 data[length]
+    trailer  index_offset:u64 frame_count:u64 magic
+
+all integers being little endian. Each frame is stored in its own record,
+whose kind tells how its data is compressed. A frame identical to an earlier
+one is stored as a REFERENCE record, whose data is the u64 offset of the
+record holding the earlier frame. The last record has kind INDEX
+and holds the offset of every frame record, so that frames can be found
+without scanning the whole file. The trailer points to this last record.
+'''
+import lzma
+import struct
+import zlib
+import wif.reading
+import wif.stats
+
+
+MAGIC = b'WIF2'
+VERSION = 2
+
+HEADER = struct.Struct('<4sHH')
+RECORD = struct.Struct('<BQQ')
+TARGET = struct.Struct('<Q')
+TRAILER = struct.Struct('<QQ4s')
+
+RAW = 0
+ZLIB = 1
+LZMA = 2
+REFERENCE = 3
+INDEX = 255
+
+COMPRESSIONS = {
+    'none': RAW,
+    'zlib': ZLIB,
+    'lzma': LZMA,
+}
+
+
+def is_container(block):
+    return bytes(block[:len(MAGIC)]) == MAGIC
+
+
+def is_container_file(path):
+    with open(path, 'rb') as file:
+        return is_container(file.read(len(MAGIC)))
+
+
+def _compress(kind, frame):
+    if kind == ZLIB:
+        return zlib.compress(frame)
+    elif kind == LZMA:
+        return lzma.compress(frame)
+    else:
+        return frame
+
+
+def _decompress(kind, data, size):
+    if kind == RAW:
+        return bytes(data[:size])
+    elif kind == ZLIB:
+        return zlib.decompressobj().decompress(data, size)
+    elif kind == LZMA:
+        return lzma.LZMADecompressor().decompress(data, size)
+    else:
+        raise ValueError(f'Unknown record kind {kind}')
+
+
+def decode_record(record):
+    '''
+    Returns the frame stored in a record.
+    '''
+    kind, length, size = RECORD.unpack_from(record)
+    with memoryview(record)[RECORD.size:RECORD.size + length] as data:
+        return _decompress(kind, data, size)
+
+
+def decoded_size(record):
+    '''
+    Returns the size of the frame stored in a record.
+    '''
+    _, _, size = RECORD.unpack_from(record)
+    return size
+
+
+def describe_record(record):
+    '''
+    Returns (payload size, frame size, width, height) of a record,
+    decompressing only the frame header.
+    '''
+    kind, length, size = RECORD.unpack_from(record)
+    with memoryview(record)[RECORD.size:RECORD.size + length] as data:
+        width, height = struct.unpack_from('<2I', _decompress(kind, data, 8))
+    return (length, size, width, height)
+
+
+def locate_record(buffer, start, end):
+    '''
+    Returns the (start, end) position of the record holding the data of the record
+    at the given position, which differs from it for REFERENCE records.
+    '''
+    kind, _, _ = RECORD.unpack_from(buffer, start)
+    if kind != REFERENCE:
+        return (start, end)
+    start, = TARGET.unpack_from(buffer, start + RECORD.size)
+    _, length, _ = RECORD.unpack_from(buffer, start)
+    return (start, start + RECORD.size + length)
+
+
+class RecordScanner:
+    '''
+    Finds frame records in a stream of blocks.
+    Counterpart of wif.reading.FrameScanner for WIF2 streams.
+    When scanning a stream, the record a REFERENCE record refers to is long gone,
+    so a wif.reading.FrameReference to the index of its frame is yielded instead.
+    When scanning a whole buffer, REFERENCE records are replaced by the record they refer to.
+    '''
+    def __init__(self):
+        self.__buffer = bytearray()
+        self.__offset = 0
+        self.__position = None
+        self.__finished = False
+        # Maps the offset of each frame record to the index of its frame
+        self.__frame_indices = {}
+        self.__frame_count = 0
+        self.__record_offset = None
+
+    @property
+    def payload_offset(self):
+        '''
+        Position in the stream of the record that was yielded last.
+        '''
+        return self.__record_offset
+
+    def feed(self, block):
+        '''
+        Adds a block and yields each frame record it completes, header included,
+        or a FrameReference for a REFERENCE record.
+        Records are memoryviews which are only valid until the next record is requested.
+        '''
+        if self.__finished:
+            return
+
+        self.__compact()
+        self.__buffer += block
+
+        if self.__position is None:
+            if len(self.__buffer) < HEADER.size:
+                return
+            magic, version, _ = HEADER.unpack_from(self.__buffer)
+            if magic != MAGIC or version > VERSION:
+                raise ValueError('Not a supported WIF2 stream')
+            self.__position = HEADER.size
+
+        while len(self.__buffer) - self.__position >= RECORD.size:
+            kind, length, _ = RECORD.unpack_from(self.__buffer, self.__position)
+            if kind == INDEX:
+                self.__finished = True
+                return
+            end = self.__position + RECORD.size + length
+            if len(self.__buffer) < end:
+                return
+
+            offset = self.__offset + self.__position
+            with memoryview(self.__buffer) as view, view[self.__position:end] as record:
+                if kind == REFERENCE:
+                    target, = TARGET.unpack_from(record, RECORD.size)
+                    self.__record_offset = offset
+                    self.__frame_count += 1
+                    yield wif.reading.FrameReference(self.__frame_indices[target])
+                else:
+                    self.__frame_indices[offset] = self.__frame_count
+                    self.__record_offset = offset
+                    self.__frame_count += 1
+                    yield record
+
+            self.__position = end
+
+    @staticmethod
+    def scan(buffer):
+        '''
+        Yields (offset, record) for each frame record in a buffer holding a whole stream,
+        e.g., a memory mapped file. Records are views on the buffer.
+        '''
+        magic, version, _ = HEADER.unpack_from(buffer)
+        if magic != MAGIC or version > VERSION:
+            raise ValueError('Not a supported WIF2 stream')
+        position = HEADER.size
+
+        with memoryview(buffer) as view:
+            while len(buffer) - position >= RECORD.size:
+                kind, length, _ = RECORD.unpack_from(buffer, position)
+                end = position + RECORD.size + length
+                if kind == INDEX or len(buffer) < end:
+                    return
+
+                start, stop = locate_record(buffer, position, end)
+                with view[start:stop] as record:
+                    yield (start, record)
+
+                position = end
+
+    def __compact(self):
+        if self.__position is not None:
+            del self.__buffer[:self.__position]
+            self.__offset += self.__position
+            self.__position = 0
+
+    decode = staticmethod(decode_record)
+    decoded_size = staticmethod(decoded_size)
+    describe = staticmethod(describe_record)
+
+
+def read_index(stream):
+    '''
+    Reads the (start, end) positions of all frame records from the trailer
+    of a seekable WIF2 stream. Returns None if the trailer is missing,
+    e.g., because writing the file was interrupted.
+    '''
+    size = stream.seek(0, 2)
+    if size < HEADER.size + RECORD.size + TRAILER.size:
+        return None
+
+    stream.seek(size - TRAILER.size)
+    index_offset, frame_count, magic = TRAILER.unpack(stream.read(TRAILER.size))
+    if magic != MAGIC or index_offset + RECORD.size > size - TRAILER.size:
+        return None
+
+    stream.seek(index_offset)
+    kind, length, count = RECORD.unpack(stream.read(RECORD.size))
+    if kind != INDEX or count != frame_count or length != 8 * count:
+        return None
+
+    offsets = list(struct.unpack(f'<{count}Q', stream.read(length)))
+    return list(zip(offsets, offsets[1:] + [index_offset]))
+
+
+def write_container(frames, stream, compression='zlib'):
+    '''
+    Writes frames to a binary stream in the WIF2 format.
+    Frames that do not get smaller when compressed are stored as is.
+    A wif.reading.FrameReference is stored as a REFERENCE record.
+    The stream does not need to be seekable.
+    '''
+    kind = COMPRESSIONS[compression]
+    compress = wif.stats.instrument_function('compress', _compress, size=len)
+    offsets = []
+    # Position and size of the record holding each frame's data
+    sources = []
+
+    stream.write(HEADER.pack(MAGIC, VERSION, 0))
+    position = HEADER.size
+
+    for frame in frames:
+        offsets.append(position)
+        if isinstance(frame, wif.reading.FrameReference):
+            source, size = sources[frame.index]
+            record_kind = REFERENCE
+            data = TARGET.pack(source)
+        else:
+            source, size = position, len(frame)
+            data = compress(kind, frame)
+            record_kind = kind
+            if len(data) >= len(frame):
+                data = frame
+                record_kind = RAW
+        sources.append((source, size))
+        stream.write(RECORD.pack(record_kind, len(data), size))
+        stream.write(data)
+        position += RECORD.size + len(data)
+
+    index = struct.pack(f'<{len(offsets)}Q', *offsets)
+    stream.write(RECORD.pack(INDEX, len(index), len(offsets)))
+    stream.write(index)
+    stream.write(TRAILER.pack(position, len(offsets), MAGIC))
@@ -1,14 +1,249 @@
+import binascii
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import time
 import cv2
 import numpy
+import wif.container
+import wif.concurrency
+import wif.reading
+import wif.stats
 
 
-def create_mp4(images, output, codec='avc1'):
+# Number of distinct frames create_mp4 keeps to repeat for a FrameReference
+MOVIE_HISTORY = 4
+
+# Number of frames that can be waiting to be encoded
+_encoder_queue_size = 8
+
+
+def _to_array(image):
+    '''
+    Returns the RGB pixels of an image as an array, without copying arrays.
+    '''
+    if isinstance(image, (numpy.ndarray, wif.reading.FrameReference)):
+        return image
+    else:
+        return numpy.asarray(image)
+
+
+def _encode(frames, output, codec, fps):
+    '''
+    Writes the frames received from a channel to a movie.
+    Returns the number of frames written.
+    '''
     writer = None
-    for image in images:
-        if not writer:
-            codec = cv2.VideoWriter_fourcc(*codec)
-            writer = cv2.VideoWriter(output, codec, 30, image.size)
-        converted = cv2.cvtColor(numpy.array(image), cv2.COLOR_RGB2BGR)
-        writer.write(converted)
-    if writer:
-        writer.release()
+    converted_frames = collections.OrderedDict()
+    frame_count = 0
+    convert_color = wif.stats.instrument_function('convert colors', cv2.cvtColor, size=lambda array: array.nbytes)
+    try:
+        for index, frame in enumerate(frames):
+            if isinstance(frame, wif.reading.FrameReference):
+                converted = converted_frames[frame.index]
+                converted_frames.move_to_end(frame.index)
+            else:
+                if not writer:
+                    height, width, _ = frame.shape
+                    writer = cv2.VideoWriter(output, cv2.VideoWriter_fourcc(*codec), fps, (width, height))
+                    if not writer.isOpened():
+                        raise ValueError(f'Cannot write {output} using codec {codec}')
+                    write = wif.stats.instrument_function('encode', writer.write)
+                converted = convert_color(frame, cv2.COLOR_RGB2BGR)
+                converted_frames[index] = converted
+                if len(converted_frames) > MOVIE_HISTORY:
+                    converted_frames.popitem(last=False)
+            write(converted)
+            frame_count += 1
+        return frame_count
+    finally:
+        # Stops the producer if encoding failed
+        frames.close()
+        if writer:
+            writer.release()
+
+
+def create_mp4(images, output, codec='avc1', fps=30):
+    '''
+    Encodes images into a movie and returns the number of frames encoded per second.
+    Images can be height x width x 3 RGB arrays, which are not copied, or PIL images.
+    They can also be FrameReferences to one of the last MOVIE_HISTORY distinct images,
+    as produced by a DuplicateDetector with that history, which are not converted again.
+    Encoding happens on a thread of its own, so that it overlaps with producing the images.
+    '''
+    start = time.perf_counter()
+    frames = wif.concurrency.Channel(_encoder_queue_size)
+    # Time spent sending is time spent waiting for the encoder to catch up
+    send = wif.stats.instrument_function('wait for encoder', frames.send)
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        encoding = executor.submit(_encode, frames, output, codec, fps)
+        try:
+            for image in images:
+                send(_to_array(image))
+        except wif.concurrency.ChannelClosed:
+            # The encoder failed, its error is raised below
+            pass
+        finally:
+            frames.close()
+        frame_count = encoding.result()
+    elapsed = time.perf_counter() - start
+    return frame_count / elapsed if elapsed > 0 else 0.0
+
+
+def write_wif(frames, stream):
+    '''
+    Writes frames to a binary stream in the WIF format, one frame at a time.
+    '''
+    encode = wif.stats.instrument_function('encode', binascii.b2a_base64, size=len)
+    for frame in frames:
+        stream.write(b'<<<')
+        stream.write(encode(frame, newline=False))
+        stream.write(b'>>>\n')
+
+
+def create_wif(frames, output):
+    with open(output, 'wb') as file:
+        write_wif(frames, file)
+
+
+def create_wif2(frames, output, compression='zlib'):
+    with open(output, 'wb') as file:
+        wif.container.write_container(frames, file, compression=compression)
+
+
+def write_raw_video(arrays, stream):
+    '''
+    Writes height x width x 3 arrays to a binary stream as raw 24 bit RGB pixels,
+    without any header or delimiters, which is what ffmpeg expects from
+
+        ffmpeg -f rawvideo -pixel_format rgb24 -video_size WIDTHxHEIGHT -i - ...
+
+    All frames must have the same size. Returns the number of frames written.
+    '''
+    shape = None
+    count = 0
+    for array in arrays:
+        if shape is None:
+            shape = array.shape
+        elif array.shape != shape:
+            raise ValueError(f'Raw video frames must all have the same size, got {array.shape} after {shape}')
+        stream.write(memoryview(numpy.ascontiguousarray(array, dtype=numpy.uint8)))
+        count += 1
+    return count
+
+
+_manifest_name = '.wif-frames.json'
+
+
+def _load_manifest(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_manifest(path, manifest):
+    with open(path, 'w') as file:
+        json.dump(manifest, file)
+
+
+def _save_frame(frame, path):
+    '''
+    Runs in a worker process.
+    '''
+    wif.reading.frame_to_image(frame).save(path)
+
+
+def check_pattern(pattern):
+    '''
+    Raises a ValueError unless pattern holds a single integer placeholder such as %05d,
+    which is needed to give each image a file name of its own.
+    '''
+    try:
+        distinct = pattern % 0 != pattern % 1
+    except (TypeError, ValueError):
+        distinct = False
+    if not distinct:
+        raise ValueError(f'Pattern {pattern} needs a placeholder for the frame index, e.g., %05d')
+
+
+def create_image_sequence(frames, directory, pattern='frame_%05d.png', indices=None, workers=0, only_changed=True):
+    '''
+    Saves each frame to an image file in directory, named by filling in
+    its index in pattern, whose extension determines the image format.
+    Indices default to 0, 1, 2, ...
+    Images are compressed by a pool of worker processes, 0 meaning one per core.
+    A manifest of the frames written is kept in the directory, so that
+    files already holding the same frame are not written again.
+    Frames identical to one written before are copied instead of compressed again,
+    which is also how a FrameReference is handled.
+    Returns the number of files written and skipped.
+    '''
+    check_pattern(pattern)
+    if indices is None:
+        indices = itertools.count()
+    workers = workers or os.cpu_count()
+    os.makedirs(directory, exist_ok=True)
+    manifest_path = os.path.join(directory, _manifest_name)
+    manifest = _load_manifest(manifest_path) if only_changed else {}
+    # Maps the hash of each frame to the first file holding it
+    filenames = {}
+    # Hash of each frame by position, for FrameReferences to look up
+    digests = []
+    pending = collections.deque()
+    copies = []
+    written = 0
+    skipped = 0
+
+    # Time spent waiting for results is time spent waiting for the workers to catch up
+    wait = wif.stats.instrument_function('save images', concurrent.futures.Future.result)
+
+    def finish(saving):
+        future, filename, digest = saving
+        wait(future)
+        manifest[filename] = digest
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        try:
+            for index, frame in zip(indices, frames):
+                filename = pattern % index
+                path = os.path.join(directory, filename)
+                if isinstance(frame, wif.reading.FrameReference):
+                    digest = digests[frame.index]
+                else:
+                    digest = hashlib.blake2b(frame, digest_size=16).hexdigest()
+                digests.append(digest)
+                if manifest.get(filename) == digest and os.path.exists(path):
+                    filenames.setdefault(digest, filename)
+                    skipped += 1
+                    continue
+
+                # The file is out of date until it has been written
+                manifest.pop(filename, None)
+                if digest in filenames:
+                    copies.append((filenames[digest], filename, digest))
+                    continue
+
+                filenames[digest] = filename
+                written += 1
+                pending.append((executor.submit(_save_frame, bytes(frame), path), filename, digest))
+                if len(pending) >= 2 * workers:
+                    finish(pending.popleft())
+
+            while pending:
+                finish(pending.popleft())
+
+            for source, filename, digest in copies:
+                shutil.copyfile(os.path.join(directory, source), os.path.join(directory, filename))
+                manifest[filename] = digest
+        finally:
+            for future, _, _ in pending:
+                future.cancel()
+            _save_manifest(manifest_path, manifest)
+
+    return (written + len(copies), skipped)
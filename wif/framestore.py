@@ -0,0 +1,153 @@
+'''
+Keeps a growing sequence of frames within a memory budget.
+'''
+from threading import Lock
+import collections
+import tempfile
+import zlib
+import numpy
+from PIL import Image
+import wif.config
+import wif.reading
+
+
+class _Frame:
+    '''
+    Where the data of a frame is kept: either in memory or at a position in the temporary file.
+    '''
+    def __init__(self, shape, data):
+        self.shape = shape
+        self.data = data
+        self.position = None
+
+
+class FrameStore:
+    '''
+    Stores frames as raw RGB pixels, optionally compressed.
+    Once the frames kept in memory exceed the budget, the least recently used
+    ones are moved to a temporary file, from which they are read back when needed.
+    A FrameReference is stored as a reference to the frame it refers to,
+    so that duplicate frames take no extra space.
+    Frames can be added and read from different threads.
+    '''
+    def __init__(self, budget=None, compress=None):
+        if budget is None:
+            budget = wif.config.configuration['frame_store_budget']
+        if compress is None:
+            compress = wif.config.configuration['frame_store_compression']
+        self.__budget = budget
+        self.__compress = compress
+        self.__lock = Lock()
+        self.__frames = []
+        # The frames whose data is kept in memory, least recently used first
+        self.__memory = collections.OrderedDict()
+        self.__memory_size = 0
+        self.__file = None
+        self.__file_size = 0
+        self.__closed = False
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__frames)
+
+    @property
+    def memory_size(self):
+        '''
+        Number of bytes of frame data kept in memory.
+        '''
+        return self.__memory_size
+
+    @property
+    def file_size(self):
+        '''
+        Number of bytes of frame data moved to the temporary file.
+        '''
+        return self.__file_size
+
+    def append(self, frame):
+        '''
+        Adds a frame, which is a height x width x 3 array, a PIL image or a FrameReference.
+        '''
+        if isinstance(frame, wif.reading.FrameReference):
+            with self.__lock:
+                self.__frames.append(self.__frames[frame.index])
+            return
+
+        pixels = numpy.asarray(frame, dtype=numpy.uint8)
+        data = pixels.tobytes()
+        if self.__compress:
+            data = zlib.compress(data, 1)
+        frame = _Frame(pixels.shape, data)
+        with self.__lock:
+            if self.__closed:
+                raise ValueError('Frame store has been closed')
+            self.__frames.append(frame)
+            self.__memory[frame] = None
+            self.__memory_size += len(data)
+            while self.__memory_size > self.__budget and len(self.__memory) > 1:
+                self.__spill()
+
+    def array(self, index):
+        '''
+        Returns a frame as a height x width x 3 array.
+        '''
+        with self.__lock:
+            frame = self.__frames[index]
+            data = self.__load(frame)
+        if self.__compress:
+            data = zlib.decompress(data)
+        return numpy.frombuffer(data, dtype=numpy.uint8).reshape(frame.shape)
+
+    def image(self, index):
+        return Image.fromarray(self.array(index))
+
+    def __getitem__(self, index):
+        return self.array(index)
+
+    def __iter__(self):
+        '''
+        Yields all frames as arrays, including the ones added while iterating.
+        '''
+        index = 0
+        while index < len(self):
+            yield self.array(index)
+            index += 1
+
+    def close(self):
+        with self.__lock:
+            self.__closed = True
+            self.__frames.clear()
+            self.__memory.clear()
+            self.__memory_size = 0
+            if self.__file:
+                self.__file.close()
+                self.__file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __spill(self):
+        '''
+        Moves the least recently used data to the temporary file.
+        '''
+        frame, _ = self.__memory.popitem(last=False)
+        if self.__file is None:
+            self.__file = tempfile.TemporaryFile()
+        self.__file.seek(self.__file_size)
+        self.__file.write(frame.data)
+        frame.position = (self.__file_size, len(frame.data))
+        self.__file_size += len(frame.data)
+        self.__memory_size -= len(frame.data)
+        frame.data = None
+
+    def __load(self, frame):
+        if frame.data is not None:
+            self.__memory.move_to_end(frame)
+            return frame.data
+        offset, size = frame.position
+        self.__file.seek(offset)
+        return self.__file.read(size)
+
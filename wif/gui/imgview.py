@@ -1,27 +1,59 @@
 from PIL import ImageTk
+import collections
+import concurrent.futures
+import time
 import tkinter as tk
 import wif.encoding
 import wif.concurrency
+import wif.framestore
 from tkinter import filedialog
 
 
 _save_movie_caption = 'Save movie'
 _save_frame_caption = 'Save frame'
+_channel_capacity = 32
+# Number of PhotoImages kept around for showing again
+_photo_window = 32
+# Number of frames ahead of the current one in the playback direction that are prepared in advance
+_prefetch_count = 8
+# Time in seconds that may be spent creating PhotoImages per conversion tick
+_conversion_budget = 0.010
+# Time in milliseconds between conversion ticks
+_conversion_interval = 15
 
 
 class ImageViewer(tk.Frame):
+    '''
+    Shows frames, given as height x width x 3 arrays or PIL images.
+    '''
     def __init__(self, parent, images):
         super().__init__(parent)
         self.__menu = self.__create_menu()
-        self.__original_images = []
-        self.__converted_images = []
+        self.__frames = wif.framestore.FrameStore()
+        self.__photos = collections.OrderedDict()
+        # Frames being read from the store off the Tk thread, by index
+        self.__loading = {}
+        self.__loader = concurrent.futures.ThreadPoolExecutor(1)
+        self.__shown_index = None
+        self.__direction = 1
+        self.__closed = False
+        self.bind('<Destroy>', self.__on_destroy)
         self.__create_variables()
         self.__create_widgets()
         self.__create_keybindings()
         self.__done_receiving_images = False
         self.__tick()
+        self.__convert_loaded_images()
         self.__read_images_in_background(images)
 
+    def __on_destroy(self, event):
+        if event.widget is self:
+            self.__closed = True
+            self.__loader.shutdown(wait=False, cancel_futures=True)
+            # Stops the background thread storing frames
+            self.__image_channel.close()
+            self.__frames.close()
+
     def __create_keybindings(self):
         self.bind_all('<space>', lambda event: self.__toggle_animation())
 
@@ -53,7 +85,7 @@ class ImageViewer(tk.Frame):
                                                 defaultextension='.png')
 
         if filename:
-            image = self.__original_images[self.__image_index.get()]
+            image = self.__frames.image(self.__image_index.get())
             image.save(filename)
 
     def __save_movie(self):
@@ -61,36 +93,57 @@ class ImageViewer(tk.Frame):
         filename = filedialog.asksaveasfilename(filetypes=filetypes,
                                                 defaultextension='.mp4')
         if filename:
+            fps = self.__fps.get()
+
             def task():
-                wif.encoding.create_mp4(self.__original_images, filename)
+                wif.encoding.create_mp4(self.__frames, filename, fps=fps)
             wif.concurrency.run_in_background(task)
 
     def __read_images_in_background(self, images):
-        converted_images = self.__convert_images(images)
-        channel = wif.concurrency.generate_in_background(converted_images)
+        channel = wif.concurrency.generate_in_background(self.__store_images(images), capacity=_channel_capacity)
+        self.__image_channel = channel
 
         def fetch_images_from_channel():
+            if self.__closed:
+                return
             while not channel.empty:
-                original_image, converted_image = channel.receive()
-                self.__original_images.append(original_image)
-                self.__converted_images.append(converted_image)
-            self.__framecount.set(len(self.__converted_images))
+                channel.receive()
+            self.__framecount.set(len(self.__frames))
             self.__status.set(f'Received frame #{self.__framecount.get()}')
+            # Lets the newly received frames be prefetched
+            self.__update()
             if not channel.finished:
                 self.after(100, fetch_images_from_channel)
             else:
-                self.__on_done_receiving_images()
+                self.__on_done_receiving_images(channel.error)
 
         fetch_images_from_channel()
 
-    def __on_done_receiving_images(self):
+    def __store_images(self, images):
+        '''
+        Runs on a background thread. Yields after storing each image, so that the viewer can catch up.
+        '''
+        try:
+            for image in images:
+                self.__frames.append(image)
+                yield None
+        finally:
+            # Stops reading, and rendering, once the viewer has been closed
+            close = getattr(images, 'close', None)
+            if close:
+                close()
+
+    def __on_done_receiving_images(self, error=None):
         '''
         Called when all images have been received.
         '''
         self.__done_receiving_images = True
         self.__save_menu.entryconfig(_save_movie_caption, state='normal')
         self.__save_menu.entryconfig(_save_frame_caption, state='normal')
-        self.__status.set(f'Finished! Received {self.__framecount.get()} frames')
+        if error:
+            self.__status.set(f'Stopped after {self.__framecount.get()} frames: {error}')
+        else:
+            self.__status.set(f'Finished! Received {self.__framecount.get()} frames')
 
     def __create_variables(self):
         self.__create_frame_index_variable()
@@ -192,15 +245,70 @@ class ImageViewer(tk.Frame):
             self.__menu.grab_release()
 
     def __update(self):
-        if self.__converted_images:
-            index = self.__image_index.get()
-            image = self.__converted_images[index]
-            self.__label.configure(image=image)
-            self.__label.image = image
+        count = self.__framecount.get()
+        if self.__closed or count == 0:
+            return
+        index = self.__image_index.get()
+        if self.__shown_index is not None and index != self.__shown_index:
+            step = (index - self.__shown_index) % count
+            # Moving more than halfway round means going backwards
+            self.__direction = 1 if step <= count // 2 else -1
+        if index in self.__photos:
+            self.__show(index)
+        self.__prefetch(index)
+
+    def __show(self, index):
+        self.__photos.move_to_end(index)
+        image = self.__photos[index]
+        self.__label.configure(image=image)
+        self.__label.image = image
+        self.__shown_index = index
+
+    def __prefetch(self, index):
+        '''
+        Starts reading the current frame and the ones following it in the playback direction
+        from the store on a background thread. Frames that are no longer needed are not read.
+        '''
+        count = self.__framecount.get()
+        wanted = [(index + self.__direction * offset) % count for offset in range(min(_prefetch_count + 1, count))]
+        for stale in set(self.__loading) - set(wanted):
+            if self.__loading[stale].cancel():
+                del self.__loading[stale]
+        for wanted_index in wanted:
+            if wanted_index not in self.__photos and wanted_index not in self.__loading:
+                self.__loading[wanted_index] = self.__loader.submit(self.__frames.image, wanted_index)
+
+    def __convert_loaded_images(self):
+        '''
+        Creates PhotoImages for the frames read by the background thread.
+        PhotoImages can only be created on the Tk thread, which is kept responsive
+        by converting only as many frames per tick as fit in the time budget.
+        The current frame goes first.
+        '''
+        if self.__closed:
+            return
+        deadline = time.perf_counter() + _conversion_budget
+        current = self.__image_index.get()
+        loaded = sorted((index for index, future in self.__loading.items() if future.done()),
+                        key=lambda index: index != current)
+        for index in loaded:
+            if time.perf_counter() > deadline:
+                break
+            future = self.__loading.pop(index)
+            if future.cancelled() or future.exception():
+                continue
+            self.__photos[index] = self.__convert_image(future.result())
+            if len(self.__photos) > _photo_window:
+                self.__photos.popitem(last=False)
+            if index == current:
+                self.__show(index)
+        self.after(_conversion_interval, self.__convert_loaded_images)
 
     def __tick(self):
-        if self.__converted_images:
-            new_index = (self.__image_index.get() + 1) % len(self.__converted_images)
+        if self.__closed:
+            return
+        if self.__framecount.get() > 0:
+            new_index = (self.__image_index.get() + 1) % self.__framecount.get()
             self.__image_index.set(new_index)
         if self.__animating.get():
             self.__schedule_tick()
@@ -210,7 +318,3 @@ class ImageViewer(tk.Frame):
 
     def __convert_image(self, image):
         return ImageTk.PhotoImage(image)
-
-    def __convert_images(self, images):
-        for image in images:
-            yield (image, self.__convert_image(image))
@@ -1,19 +1,222 @@
+from threading import Lock
+import collections
+import re
+import tempfile
 import tkinter as tk
 import wif.concurrency
+import wif.config
 from tkinter.scrolledtext import ScrolledText
 
 
+# Time in milliseconds between fetching new messages
+_fetch_interval = 100
+_search_tag = 'search'
+
+
+# Counters that tell how far along something is: percentages, "12/100", "frame 12" and the like
+_progress_pattern = re.compile(r'\d+(\.\d+)?%|\d+ */ *\d+|\b(frame|sample|pass|tile|row|step) +#?\d+', re.IGNORECASE)
+
+
+def _progress_key(line):
+    '''
+    Consecutive lines with the same key are progress updates, e.g.,
+    "Rendering frame 1" and "Rendering frame 2", of which only the last is shown.
+    Lines are only progress updates if they are identical apart from their counters,
+    so that, e.g., "error at line 12" and "error at line 15" are both shown.
+    '''
+    key, count = _progress_pattern.subn('#', line)
+    return key if count else None
+
+
+class _MessageLog:
+    '''
+    Receives messages on a background thread. All messages are written
+    to a temporary file, while only the most recent ones are kept in memory
+    until the viewer gets round to showing them.
+    '''
+    def __init__(self, messages, line_limit):
+        self.__lock = Lock()
+        self.__file = tempfile.TemporaryFile('w+', encoding='utf-8')
+        self.__pending = collections.deque(maxlen=line_limit or None)
+        self.__line_count = 0
+        self.__channel = wif.concurrency.generate_in_background(self.__receive(messages))
+
+    def __receive(self, messages):
+        for message in messages:
+            with self.__lock:
+                if self.__file.closed:
+                    return
+                self.__file.write(message)
+                self.__pending.append(message)
+                self.__line_count += 1
+        # Nothing needs to be sent, the channel only tells when receiving is done
+        yield from ()
+
+    @property
+    def finished(self):
+        return self.__channel.finished
+
+    @property
+    def line_count(self):
+        return self.__line_count
+
+    def take_pending(self):
+        '''
+        Returns the messages received since the last call.
+        '''
+        with self.__lock:
+            messages = list(self.__pending)
+            self.__pending.clear()
+        return messages
+
+    def lines(self):
+        '''
+        Returns all messages received so far.
+        '''
+        with self.__lock:
+            self.__file.flush()
+            self.__file.seek(0)
+            lines = self.__file.readlines()
+            self.__file.seek(0, 2)
+        return lines
+
+    def close(self):
+        with self.__lock:
+            self.__file.close()
+
+
 class MessageViewer(tk.Frame):
-    def __init__(self, parent, messages):
+    '''
+    Shows the messages of the raytracer. New messages are added in batches,
+    repeated progress lines are collapsed into one and only the last
+    line_limit lines are shown. The full log is kept on disk,
+    where filtering looks for matching lines.
+    '''
+    def __init__(self, parent, messages, line_limit=None):
         super().__init__(parent)
+        if line_limit is None:
+            line_limit = wif.config.configuration['message_line_limit']
+        self.__line_limit = line_limit
+        # The lines being shown, most recent last
+        self.__lines = collections.deque(maxlen=line_limit or None)
+        self.__last_key = None
+        self.__filter = tk.StringVar(value='')
+        self.__search = tk.StringVar(value='')
+        self.__status = tk.StringVar(value='')
+        self.__create_widgets()
+        self.__log = _MessageLog(messages, line_limit)
+        self.bind('<Destroy>', lambda event: self.__log.close() if event.widget is self else None)
+        self.__fetch_messages()
+
+    def __create_widgets(self):
+        top_frame = tk.Frame(self)
+        top_frame.pack(side=tk.TOP, fill=tk.X)
+
+        tk.Label(top_frame, text='Filter').pack(side=tk.LEFT)
+        filter_entry = tk.Entry(top_frame, textvariable=self.__filter)
+        filter_entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        filter_entry.bind('<Return>', lambda event: self.__apply_filter())
+
+        tk.Label(top_frame, text='Find').pack(side=tk.LEFT)
+        search_entry = tk.Entry(top_frame, textvariable=self.__search)
+        search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        search_entry.bind('<Return>', lambda event: self.__find_next())
+
+        status_label = tk.Label(self, anchor=tk.W, textvariable=self.__status)
+        status_label.pack(side=tk.BOTTOM, fill=tk.X)
+
         self.__view = ScrolledText(self)
         self.__view.pack(fill=tk.BOTH, expand=True)
-        self.__message_channel = wif.concurrency.generate_in_background(messages)
-        self.__fetch_messages()
+        self.__view.tag_configure(_search_tag, background='yellow')
 
     def __fetch_messages(self):
-        while not self.__message_channel.empty:
-            message = self.__message_channel.receive()
-            self.__view.insert(tk.END, message)
-        if not self.__message_channel.finished:
-            self.after(500, self.__fetch_messages)
+        # Checked first, so that messages arriving in between are still taken
+        finished = self.__log.finished
+        messages = self.__log.take_pending()
+        if messages:
+            replace_last, batch = self.__collapse(messages)
+            if not self.__filter.get():
+                self.__add_lines(replace_last, batch)
+            self.__status.set(f'{self.__log.line_count} lines')
+        if not finished:
+            self.after(_fetch_interval, self.__fetch_messages)
+
+    def __collapse(self, messages):
+        '''
+        Adds messages to the lines being shown, collapsing progress updates.
+        Returns whether the last line shown needs to be replaced, and the lines to add.
+        '''
+        replace_last = False
+        batch = []
+        for message in messages:
+            key = _progress_key(message)
+            if key is not None and key == self.__last_key:
+                if batch:
+                    batch[-1] = message
+                else:
+                    replace_last = True
+                    batch.append(message)
+                self.__lines[-1] = message
+            else:
+                batch.append(message)
+                self.__lines.append(message)
+            self.__last_key = key
+        return (replace_last, batch)
+
+    def __add_lines(self, replace_last, batch):
+        '''
+        Adds lines to the view using a single insertion.
+        '''
+        if replace_last:
+            self.__view.delete('end - 1 lines linestart - 1 lines', 'end - 1 lines linestart')
+        self.__view.insert(tk.END, ''.join(batch))
+        self.__limit_lines()
+        self.__view.see(tk.END)
+
+    def __limit_lines(self):
+        if self.__line_limit:
+            # The text always ends with an empty line
+            excess = int(self.__view.index('end - 1 lines').split('.')[0]) - 1 - self.__line_limit
+            if excess > 0:
+                self.__view.delete('1.0', f'{excess + 1}.0')
+
+    def __show(self, lines):
+        self.__view.delete('1.0', tk.END)
+        self.__view.insert(tk.END, ''.join(lines))
+        self.__view.see(tk.END)
+
+    def __apply_filter(self):
+        '''
+        Shows the lines of the full log containing the filter text, ignoring case.
+        An empty filter shows the most recent lines again.
+        '''
+        text = self.__filter.get().lower()
+        if not text:
+            self.__show(self.__lines)
+            self.__status.set(f'{self.__log.line_count} lines')
+            return
+        matches = [line for line in self.__log.lines() if text in line.lower()]
+        if self.__line_limit:
+            shown = matches[-self.__line_limit:]
+        else:
+            shown = matches
+        self.__show(shown)
+        self.__status.set(f'{len(matches)} of {self.__log.line_count} lines match, showing {len(shown)}')
+
+    def __find_next(self):
+        '''
+        Selects the next occurrence of the search text after the cursor, wrapping around.
+        '''
+        text = self.__search.get()
+        self.__view.tag_remove(_search_tag, '1.0', tk.END)
+        if not text:
+            return
+        start = self.__view.search(text, 'insert + 1 chars', nocase=True, stopindex=tk.END) or \
+            self.__view.search(text, '1.0', nocase=True, stopindex=tk.END)
+        if not start:
+            self.__status.set(f'{text} not found')
+            return
+        end = f'{start} + {len(text)} chars'
+        self.__view.tag_add(_search_tag, start, end)
+        self.__view.mark_set('insert', start)
+        self.__view.see(start)
@@ -1,7 +1,10 @@
 import tkinter as tk
 from tkinter import filedialog
+from tkinter import messagebox
+from tkinter import simpledialog
 from tkinter import ttk
 import wif.raytracer
+import wif.reading
 import wif.gui.msgview
 from wif.gui.viewer import ViewerWindow
 
@@ -51,6 +54,46 @@ class MenuItem:
         self.__parent.entryconfigure(self.__label, state=state)
 
 
+def _parse_selection(text):
+    '''
+    Turns "start:stop:step", in which each part may be left out, into a slice.
+    '''
+    parts = [part.strip() for part in text.split(':')]
+    if len(parts) > 3:
+        raise ValueError(f'Invalid frame range {text}')
+    values = [int(part) if part else None for part in parts]
+    if any(value is not None and value < 0 for value in values) or values[2:] == [0]:
+        raise ValueError(f'Invalid frame range {text}')
+    return slice(*values) if len(values) > 1 else slice(values[0], None)
+
+
+class RenderManager:
+    '''
+    Keeps track of the rendering of each editor tab.
+    Rendering a tab again cancels its previous rendering.
+    How many renderings run at the same time is limited by render_limit.
+    '''
+    def __init__(self):
+        self.__jobs = {}
+
+    def render(self, tab, preview_scale=1):
+        self.cancel(tab)
+        job = wif.raytracer.RenderJob(tab.script,
+                                      duplicates=wif.reading.DuplicateDetector(),
+                                      preview_scale=preview_scale)
+        self.__jobs[tab] = job
+        return job
+
+    def cancel(self, tab):
+        job = self.__jobs.pop(tab, None)
+        if job is not None:
+            job.cancel()
+
+    def cancel_all(self):
+        for tab in list(self.__jobs):
+            self.cancel(tab)
+
+
 class StudioApplication(tk.Frame):
     def __init__(self):
         self.root = tk.Tk()
@@ -59,6 +102,8 @@ class StudioApplication(tk.Frame):
         self.__create_menu()
         self.__create_notebook()
         self.__tabs = []
+        self.__renders = RenderManager()
+        self.root.bind('<Destroy>', lambda event: self.__renders.cancel_all() if event.widget is self.root else None)
         self.__update()
 
     def __initialize(self):
@@ -68,6 +113,7 @@ class StudioApplication(tk.Frame):
     def __create_menu(self):
         menubar = tk.Menu(self.master)
         self.__create_file_menu(menubar)
+        self.__create_render_menu(menubar)
         self.master.config(menu=menubar)
 
     def __create_file_menu(self, menubar):
@@ -84,25 +130,39 @@ class StudioApplication(tk.Frame):
 
         self.__new_script_menu = add_menu_item('_New script', self.__new_script, "CTRL+N")
         self.__open_file_menu = add_menu_item('_Open file', self.__open_file, "CTRL+O")
+        self.__open_frames_menu = add_menu_item('Open _frames', self.__open_frames, "CTRL+SHIFT+O")
         self.__save_menu = add_menu_item('_Save file', self.__save_file, "CTRL+S")
         self.__save_as_menu = add_menu_item('Save file _as', self.__save_file_as, "ALT+S")
-        self.__render_menu = add_menu_item('_Render', self.__render_script, "F5")
 
         self.root.bind('<Control-n>', lambda event: self.__new_script())
         self.root.bind('<Control-o>', lambda event: self.__open_file())
+        self.root.bind('<Control-O>', lambda event: self.__open_frames())
         self.root.bind('<Control-s>', lambda event: self.__save_file())
         self.root.bind('<Alt-s>', lambda event: self.__save_file_as())
-        self.root.bind('<F5>', lambda event: self.__render_script())
 
         menubar.add_cascade(menu=file_menu, label="File", underline=0)
 
+    def __create_render_menu(self, menubar):
+        render_menu = tk.Menu(menubar, tearoff=False)
+        render_menu.add_command(label='Render', underline=0, command=self.__render_script, accelerator='F5')
+        self.__render_menu = MenuItem(render_menu, 'Render')
+        self.root.bind('<F5>', lambda event: self.__render_script())
+
+        # Smaller previews take less time to decode and less memory to keep
+        render_menu.add_separator()
+        self.__preview_scale = tk.IntVar(value=1)
+        for scale in wif.reading.PREVIEW_SCALES:
+            label = 'Full size' if scale == 1 else f'1/{scale} size'
+            render_menu.add_radiobutton(label=label, variable=self.__preview_scale, value=scale)
+
+        menubar.add_cascade(menu=render_menu, label="Render", underline=0)
+
     def __render_script(self):
-        script = self.selected_tab.script
-        images, messages = wif.raytracer.raytrace(script)
-        self.__view(images, messages)
+        job = self.__renders.render(self.selected_tab, preview_scale=self.__preview_scale.get())
+        self.__view(job.arrays, job.messages, job)
 
-    def __view(self, images, messages=None):
-        ViewerWindow(tk.Toplevel(), images, messages)
+    def __view(self, images, messages=None, job=None):
+        ViewerWindow(tk.Toplevel(), images, messages, job)
 
     def __create_notebook(self):
         self.__notebook = ttk.Notebook(self.master)
@@ -117,19 +177,38 @@ class StudioApplication(tk.Frame):
         self.__tabs.append(tab)
         self.__notebook.select(len(self.__notebook.tabs()) - 1)
 
-    def __open_wif_viewer(self, path):
-        blocks = wif.reading.read_blocks_from_file(path)
-        images = wif.reading.read_images(blocks)
-        self.__view(images)
+    def __open_wif_viewer(self, path, selection=None):
+        arrays = wif.reading.read_arrays_from_file(path,
+                                                   duplicates=wif.reading.DuplicateDetector(),
+                                                   selection=selection,
+                                                   preview_scale=self.__preview_scale.get())
+        self.__view(arrays)
+
+    def __open_frames(self):
+        '''
+        Opens part of a WIF file, only decoding the frames in the given range.
+        '''
+        filename = filedialog.askopenfilename(filetypes=[('WIF files', '*.wif *.wif2')])
+        if not filename:
+            return
+        text = simpledialog.askstring('Open frames', 'Frames to show as start:stop:step', parent=self.root)
+        if text is None:
+            return
+        try:
+            selection = _parse_selection(text)
+        except ValueError:
+            messagebox.showerror('Open frames', f'{text} is not a valid frame range')
+            return
+        self.__open_wif_viewer(filename, selection)
 
     def __open_file(self):
         filetypes = [
             ('Scripts', '*.chai'),
-            ('WIF files', '*.wif'),
+            ('WIF files', '*.wif *.wif2'),
             ('All files', '*.*'),
         ]
         filename = filedialog.askopenfilename(filetypes=filetypes)
-        if filename.endswith('.wif'):
+        if filename.endswith(('.wif', '.wif2')):
             self.__open_wif_viewer(filename)
         elif filename.endswith('.chai'):
             with open(filename) as file:
@@ -6,8 +6,14 @@ import wif.gui.msgview
 
 
 class ViewerWindow(tk.Frame):
-    def __init__(self, parent, images, messages=None):
+    '''
+    Shows images and messages. Given the RenderJob producing them,
+    closing the window cancels the job.
+    '''
+    def __init__(self, parent, images, messages=None, job=None):
         super().__init__(parent)
+        self.__job = job
+        self.bind('<Destroy>', self.__on_destroy)
         self.__notebook = ttk.Notebook(self)
         self.__notebook.pack(fill=tk.BOTH, expand=True)
 
@@ -23,3 +29,7 @@ class ViewerWindow(tk.Frame):
             tab_title = 'Messages'
             self.__notebook.add(message_viewer, text=tab_title)
         self.pack(expand=True, fill=tk.BOTH)
+
+    def __on_destroy(self, event):
+        if event.widget is self and self.__job is not None:
+            self.__job.cancel()
@@ -1,39 +1,66 @@
 #!/usr/bin/env python
 
-import asyncio
 import wif.reading
 import wif.config
+import wif.container
+import wif.encoding
 import wif.gui.imgview
 from wif.gui.studio import ViewerWindow
 from wif.gui.studio import StudioApplication
 from wif.version import __version__
 import wif.raytracer
 import wif.concurrency
+import wif.cache
+import wif.bench
+import wif.batch
+import wif.stats
+from threading import Thread
+from PIL import Image
 import contextlib
+import functools
+import itertools
+import json
 import argparse
 import sys
 import os
-from threading import Thread
 
 
 @contextlib.contextmanager
 def open_output_stream(filename):
-    if filename == 'STDOUT':
+    if filename in ('-', 'STDOUT'):
         yield sys.stdout.buffer
+        sys.stdout.buffer.flush()
     else:
         with open(filename, 'wb') as file:
             yield file
 
 
 def info(args):
+    duplicates = wif.reading.DuplicateDetector() if args.duplicates else None
     if args.input == '-':
-        blocks = wif.reading.read_blocks_from_stream(sys.stdin)
+        blocks = _read_blocks(args.input)
+        infos = list(wif.reading.read_frame_infos(blocks, duplicates=duplicates))
+    elif args.duplicates and not wif.container.is_container_file(args.input):
+        # Duplicates in WIF files can only be found by hashing every frame
+        infos = list(wif.reading.read_frame_infos_from_file(args.input, duplicates=duplicates))
     else:
-        blocks = wif.reading.read_blocks_from_file(args.input)
-    sizes = []
-    for image in wif.reading.read_images(blocks):
-        sizes.append((image.width, image.height))
-        image.close()
+        # WIF2 files mark duplicates themselves
+        with wif.reading.WifFile(args.input) as file:
+            # Only frame headers are read, so no sizes are recorded
+            frame_info = wif.stats.instrument_function('describe', file.frame_info)
+            infos = [frame_info(index) for index in range(len(file))]
+    duplicate_count = sum(info.duplicate_of is not None for info in infos)
+
+    if args.json:
+        frames = [dict(index=index, **info._asdict()) for index, info in enumerate(infos)]
+        summary = {'frame_count': len(infos)}
+        if args.duplicates:
+            summary['duplicate_count'] = duplicate_count
+        json.dump({**summary, 'frames': frames}, sys.stdout, indent=2)
+        print()
+        return
+
+    sizes = [(info.width, info.height) for info in infos]
     if len(set(sizes)) == 1:
         width = sizes[0][0]
         height = sizes[0][1]
@@ -41,6 +68,8 @@ def info(args):
     else:
         for index, size in enumerate(sizes):
             print(f"Frame {index} has size {size[0]}x{size[1]}")
+    if args.duplicates:
+        print(f"{duplicate_count} frames are duplicates of an earlier frame")
 
 
 def gui(args):
@@ -55,82 +84,244 @@ def _read_script(input):
             return file.read()
 
 
-def _chai_to_wif(args):
-    script = _read_script(args.input)
-    (blocks, messages) = wif.raytracer.invoke_raytracer(script)
-
+def _print_in_background(messages, file=None):
     def print_messages():
-        for message in messages:
-            print(message, end="")
+        for message in messages or ():
+            print(message, end="", file=file or sys.stdout)
 
-    def write_blocks():
-        with open(args.output, 'w') as file:
+    printer = Thread(target=print_messages)
+    printer.start()
+    return printer
+
+
+def _chai_to_wif(args):
+    script = _read_script(args.input)
+    blocks, messages = wif.raytracer.invoke_raytracer(script,
+                                                      ignore_messages=args.quiet,
+                                                      jobs=args.jobs,
+                                                      use_cache=not args.no_cache)
+    printer = _print_in_background(messages)
+    selection = _selection(args)
+    if selection is None:
+        with open(args.output, 'wb') as file:
             for block in blocks:
                 file.write(block)
+    else:
+        wif.encoding.create_wif(wif.reading.read_frames(blocks, selection=selection), args.output)
+    printer.join()
 
-    t1 = Thread(target=print_messages)
-    t2 = Thread(target=write_blocks)
-
-    t1.start()
-    t2.start()
 
-    t1.join()
-    t2.join()
+def _chai_to_wif2(args):
+    script = _read_script(args.input)
+    blocks, _ = wif.raytracer.invoke_raytracer(script,
+                                                ignore_messages=True,
+                                                jobs=args.jobs,
+                                                use_cache=not args.no_cache)
+    frames = wif.reading.read_frames(blocks, duplicates=wif.reading.DuplicateDetector(), selection=_selection(args))
+    wif.encoding.create_wif2(frames, args.output, compression=args.compression)
 
 
 def _chai_to_mp4(args):
     script = _read_script(args.input)
-    target_filename = args.output
-    images, _ = wif.raytracer.raytrace(script, ignore_messages=True)
-    wif.encoding.create_mp4(images, target_filename, codec=args.codec)
+    blocks, _ = wif.raytracer.invoke_raytracer(script,
+                                               ignore_messages=True,
+                                               jobs=args.jobs,
+                                               use_cache=not args.no_cache)
+    arrays = wif.reading.read_arrays(blocks,
+                                     workers=args.workers,
+                                     frames_in_flight=args.frames_in_flight,
+                                     duplicates=_movie_duplicate_detector(),
+                                     selection=_selection(args))
+    _create_mp4(arrays, args)
 
 
 def _chai_to_gui(args):
     script = _read_script(args.input)
-    images, messages = wif.raytracer.raytrace(script)
-    ViewerWindow(None, images, messages).mainloop()
+    blocks, messages = wif.raytracer.invoke_raytracer(script, jobs=args.jobs, use_cache=not args.no_cache)
+    arrays = wif.reading.read_arrays(blocks,
+                                     duplicates=wif.reading.DuplicateDetector(),
+                                     selection=_selection(args),
+                                     preview_scale=args.preview_scale)
+    ViewerWindow(None, arrays, messages).mainloop()
 
 
-def _wif_to_mp4(args):
-    if args.input == '-':
-        blocks = wif.reading.read_blocks_from_stream(sys.stdin)
+def _read_blocks(input):
+    if input == '-':
+        return wif.reading.read_blocks_from_stdin()
+    else:
+        return wif.reading.read_blocks_from_file(input)
+
+
+def _read_frames(input, duplicates=None, selection=None, resolve_references=False):
+    if input == '-':
+        return wif.reading.read_frames(_read_blocks(input), duplicates, selection, resolve_references)
     else:
-        blocks = wif.reading.read_blocks_from_file(args.input)
-    images = wif.reading.read_images(blocks)
-    wif.encoding.create_mp4(images, args.output, codec=args.codec)
+        return wif.reading.read_frames_from_file(input, duplicates, selection, resolve_references)
+
+
+def _read_arrays(input,
+                 workers=None,
+                 frames_in_flight=None,
+                 duplicates=None,
+                 selection=None,
+                 preview_scale=1,
+                 resolve_references=False):
+    if input == '-':
+        blocks = _read_blocks(input)
+        return wif.reading.read_arrays(blocks, workers, frames_in_flight, duplicates, selection, preview_scale,
+                                       resolve_references)
+    else:
+        return wif.reading.read_arrays_from_file(input, workers, frames_in_flight, duplicates, selection, preview_scale,
+                                                 resolve_references)
+
+
+def _selection(args):
+    '''
+    Returns the slice of frames picked by --start, --stop and --step, or None for all frames.
+    '''
+    if args.start is None and args.stop is None and args.step is None:
+        return None
+    return slice(args.start, args.stop, args.step)
+
+
+def _movie_duplicate_detector():
+    # create_mp4 can only repeat the frames it still remembers
+    return wif.reading.DuplicateDetector(history=wif.encoding.MOVIE_HISTORY)
+
+
+def _wif_to_wif(args):
+    if args.output.endswith('wif2'):
+        frames = _read_frames(args.input, duplicates=wif.reading.DuplicateDetector(), selection=_selection(args))
+        wif.encoding.create_wif2(frames, args.output, compression=args.compression)
+    else:
+        # Text WIF cannot hold references
+        frames = _read_frames(args.input, selection=_selection(args), resolve_references=True)
+        wif.encoding.create_wif(frames, args.output)
+
+
+def _wif_to_mp4(args):
+    # Files are decoded straight from their memory mapping.
+    # References in WIF2 streams can reach further back than create_mp4 remembers.
+    arrays = _read_arrays(args.input,
+                          workers=args.workers,
+                          frames_in_flight=args.frames_in_flight,
+                          duplicates=_movie_duplicate_detector(),
+                          selection=_selection(args),
+                          resolve_references=True)
+    _create_mp4(arrays, args)
+
+
+def _create_mp4(arrays, args):
+    fps = wif.encoding.create_mp4(arrays, args.output, codec=args.codec, fps=args.fps)
+    if not args.quiet:
+        print(f'Encoded {fps:.1f} frames per second')
 
 
 def _wif_to_gui(args):
+    duplicates = wif.reading.DuplicateDetector()
     if args.input == '-':
-        blocks = wif.reading.read_blocks_from_stdin()
+        blocks = _read_blocks(args.input)
+        arrays = wif.reading.read_arrays(blocks,
+                                         duplicates=duplicates,
+                                         selection=_selection(args),
+                                         preview_scale=args.preview_scale)
     else:
-        blocks = wif.reading.read_blocks_from_file(args.input)
-    images = wif.reading.read_images(blocks)
-    ViewerWindow(None, images).mainloop()
+        arrays = wif.reading.read_arrays_from_file(args.input,
+                                                   duplicates=duplicates,
+                                                   selection=_selection(args),
+                                                   preview_scale=args.preview_scale)
+    ViewerWindow(None, arrays).mainloop()
+
+
+def _report_frame_size(arrays):
+    for index, array in enumerate(arrays):
+        if index == 0:
+            height, width, _ = array.shape
+            print(f'Writing rgb24 frames of size {width}x{height}', file=sys.stderr)
+        yield array
+
+
+def _convert_to_stream(args):
+    '''
+    Writes frames to stdout for output -, or to a .rgb24 file, one frame at a time.
+    The format is given by --format: wif, wif2 or rgb24, i.e., raw RGB pixels.
+    '''
+    format = 'rgb24' if args.output.endswith('rgb24') else args.format or 'wif'
+    if format == 'mp4':
+        raise ValueError('Movies cannot be written to stdout, use --format rgb24 and an external encoder')
+
+    selection = _selection(args)
+    printer = None
+    if args.input.endswith('chai'):
+        blocks, messages = wif.raytracer.invoke_raytracer(_read_script(args.input),
+                                                          ignore_messages=args.quiet,
+                                                          jobs=args.jobs,
+                                                          use_cache=not args.no_cache)
+        # Stdout is taken by the frames
+        printer = _print_in_background(messages, file=sys.stderr)
+        read_frames = functools.partial(wif.reading.read_frames, blocks)
+        read_arrays = functools.partial(wif.reading.read_arrays, blocks)
+    else:
+        # Files are decoded straight from their memory mapping
+        read_frames = functools.partial(_read_frames, args.input)
+        read_arrays = functools.partial(_read_arrays, args.input)
+
+    try:
+        with open_output_stream(args.output) as stream:
+            if format == 'rgb24':
+                arrays = read_arrays(workers=args.workers,
+                                     frames_in_flight=args.frames_in_flight,
+                                     selection=selection,
+                                     resolve_references=True)
+                if not args.quiet:
+                    arrays = _report_frame_size(arrays)
+                wif.encoding.write_raw_video(arrays, stream)
+            elif format == 'wif2':
+                frames = read_frames(duplicates=wif.reading.DuplicateDetector(), selection=selection)
+                wif.container.write_container(frames, stream, compression=args.compression)
+            elif args.input.endswith('chai') and selection is None:
+                # The raytracer already writes WIF
+                for block in blocks:
+                    stream.write(block)
+            else:
+                frames = read_frames(selection=selection, resolve_references=True)
+                wif.encoding.write_wif(frames, stream)
+    except BrokenPipeError:
+        # Whoever was reading the pipe quit early, which is not an error.
+        # Keeps Python from complaining when it flushes stdout on exit.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    if printer:
+        printer.join()
 
 
 def _convert(args):
     input = args.input
     output = args.output
 
-    if input.endswith('chai'):
+    if output == '-' or output.endswith('rgb24'):
+        _convert_to_stream(args)
+    elif input.endswith('chai'):
         if output.endswith('wif'):
             _chai_to_wif(args)
+        elif output.endswith('wif2'):
+            _chai_to_wif2(args)
         elif output.endswith('mp4'):
             _chai_to_mp4(args)
         elif output == 'gui':
             _chai_to_gui(args)
         else:
-            print('Unsupported conversion')
-    elif input.endswith('wif'):
-        if output.endswith('mp4'):
+            raise ValueError(f'Unsupported conversion from {input} to {output}')
+    elif input == '-' or input.endswith(('wif', 'wif2')):
+        if output.endswith(('wif', 'wif2')):
+            _wif_to_wif(args)
+        elif output.endswith('mp4'):
             _wif_to_mp4(args)
         elif output == 'gui':
             _wif_to_gui(args)
         else:
-            print('Unsupported conversion')
+            raise ValueError(f'Unsupported conversion from {input} to {output}')
     else:
-        print('Unsupported conversion')
+        raise ValueError(f'Unsupported conversion from {input} to {output}')
 
 
 def _convert_to_movie(args):
@@ -138,10 +329,61 @@ def _convert_to_movie(args):
 
     if input.endswith('chai'):
         _chai_to_mp4(args)
-    elif input.endswith('wif'):
+    elif input == '-' or input.endswith(('wif', 'wif2')):
         _wif_to_mp4(args)
     else:
-        print('Unsupported conversion')
+        raise ValueError(f'Unsupported conversion from {input} to a movie')
+
+
+def _convert_file(args, input, output):
+    '''
+    Runs in a batch worker process.
+    '''
+    if not input.endswith(wif.batch.INPUT_EXTENSIONS):
+        raise ValueError('Unsupported conversion')
+    args = argparse.Namespace(**vars(args))
+    args.input = input
+    args.output = output
+    args.quiet = True
+    args.convert(args)
+
+
+def _convert_files(args):
+    '''
+    Converts a single file, or a batch of files if several inputs,
+    glob patterns, directories or an output directory or pattern are given.
+    '''
+    if not wif.batch.is_batch(args.input, args.output):
+        args.input = args.input[0]
+        args.convert(args)
+        return
+
+    conversions, skipped = wif.batch.plan(args.input, args.output, args.format or 'mp4', force=args.force)
+    if not args.quiet and skipped:
+        print(f'Skipping {len(skipped)} files whose output is up to date')
+    done = 0
+
+    def report(conversion, seconds, error):
+        nonlocal done
+        done += 1
+        if args.quiet:
+            return
+        if error:
+            print(f'[{done}/{len(conversions)}] {conversion.input} failed: {error}')
+        else:
+            print(f'[{done}/{len(conversions)}] {conversion.input} -> {conversion.output} ({seconds:.1f}s)')
+
+    failures = wif.batch.run(functools.partial(_convert_file, args),
+                             conversions,
+                             processes=args.processes,
+                             report=report)
+    if not args.quiet:
+        print(f'Converted {len(conversions) - len(failures)} files, '
+              f'skipped {len(skipped)}, {len(failures)} failed')
+    for conversion, error in failures:
+        print(f'Failed to convert {conversion.input}: {error}', file=sys.stderr)
+    if failures:
+        sys.exit(1)
 
 
 def _extract_frame(args):
@@ -149,19 +391,83 @@ def _extract_frame(args):
     frame_index = args.frame
     output = args.output
 
-    if input.endswith('chai'):
-        script = _read_script(input)
-        images, _ = wif.raytracer.raytrace(script, ignore_messages=True)
-    else:
-        if args.input == '-':
-            blocks = wif.reading.read_blocks_from_stream(sys.stdin)
+    selection = _selection(args)
+    if input.endswith('chai') or input == '-':
+        if input == '-':
+            arrays = _read_arrays(input, selection=selection, resolve_references=True)
         else:
-            blocks = wif.reading.read_blocks_from_file(args.input)
-        images = wif.reading.read_images(blocks)
-    image = list(images)[frame_index]
+            script = _read_script(input)
+            blocks, _ = wif.raytracer.invoke_raytracer(script,
+                                                       ignore_messages=True,
+                                                       jobs=args.jobs,
+                                                       use_cache=not args.no_cache)
+            arrays = wif.reading.read_arrays(blocks, selection=selection)
+        if frame_index >= 0:
+            # Stop reading as soon as the frame has been found
+            arrays = itertools.islice(arrays, frame_index, frame_index + 1)
+            frame_index = 0
+        image = Image.fromarray(list(arrays)[frame_index])
+    else:
+        with wif.reading.WifFile(input) as file:
+            if selection is not None:
+                # The frame index counts within the selection
+                frame_index = range(len(file))[selection][frame_index]
+            image = wif.reading.frame_to_image(file[frame_index])
     image.save(output)
 
 
+def _extract_frames(args):
+    if args.input.endswith('chai'):
+        script = _read_script(args.input)
+        blocks, _ = wif.raytracer.invoke_raytracer(script,
+                                                   ignore_messages=True,
+                                                   jobs=args.jobs,
+                                                   use_cache=not args.no_cache)
+        frames = wif.reading.read_frames(blocks, selection=_selection(args))
+    else:
+        frames = _read_frames(args.input, selection=_selection(args))
+    written, skipped = wif.encoding.create_image_sequence(frames,
+                                                          args.output,
+                                                          pattern=args.pattern,
+                                                          indices=itertools.count(args.start or 0, args.step or 1),
+                                                          workers=args.workers,
+                                                          only_changed=not args.force)
+    if not args.quiet:
+        print(f'Wrote {written} images, skipped {skipped} unchanged images')
+
+
+def _parse_size(size):
+    width, height = size.lower().split('x')
+    return (int(width), int(height))
+
+
+def _parse_pattern(pattern):
+    try:
+        wif.encoding.check_pattern(pattern)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+    return pattern
+
+
+def _benchmark(args):
+    def report(result):
+        if not args.quiet:
+            print(f"{result['benchmark']:15} {result['width']}x{result['height']} "
+                  f"{result['frame_count']} frames, block size {result['block_size']}: "
+                  f"{result['frames_per_second']:.1f} frames per second", file=sys.stderr)
+
+    results = wif.bench.run_benchmarks(args.benchmarks,
+                                       sizes=[_parse_size(size) for size in args.sizes],
+                                       frame_counts=args.frame_counts,
+                                       block_sizes=args.block_sizes,
+                                       rate=args.rate,
+                                       workers=args.workers,
+                                       codec=args.codec,
+                                       report=report)
+    with open_output_stream(args.output) as stream:
+        stream.write(json.dumps(results, indent=2).encode('utf-8'))
+
+
 def _configure(args):
     if not args.setting:
         print(f'Configuration file can be found at {wif.config.get_configuration_path()}')
@@ -174,17 +480,84 @@ def _configure(args):
             if os.path.exists(value):
                 absolute_path = os.path.abspath(value)
                 wif.config.configuration['raytracer'] = absolute_path
-        elif setting == 'block_size':
-            wif.config.configuration['block_size'] = int(value)
+        elif setting in ('block_size', 'workers', 'frames_in_flight', 'cache_size', 'frame_store_budget',
+                         'message_line_limit', 'render_limit', 'batch_processes'):
+            wif.config.configuration[setting] = int(value)
+        elif setting == 'frame_store_compression':
+            wif.config.configuration[setting] = value.lower() in ('1', 'true', 'yes', 'on')
+        elif setting == 'cache_directory':
+            wif.config.configuration[setting] = os.path.abspath(value)
         else:
             raise KeyError(f'Unrecognized configuration setting {setting}')
         wif.config.write()
 
 
+def _manage_cache(args):
+    if args.action == 'clear':
+        wif.cache.clear()
+    else:
+        statistics = wif.cache.statistics()
+        print(f"Cache directory: {statistics['directory']}")
+        print(f"{statistics['entries']} renderings taking {statistics['size']} of {statistics['limit']} bytes")
+
+
 def _delete_configuration_file(args):
     wif.config.reset_configuration()
 
 
+def _add_rendering_arguments(subparser):
+    subparser.add_argument('-j', '--jobs', type=int, default=1,
+                           help='number of raytracer processes rendering chai scripts, each taking every n-th frame')
+    subparser.add_argument('--no-cache', action='store_true',
+                           help='always runs the raytracer instead of reusing an earlier rendering')
+
+
+def _add_encoding_arguments(subparser):
+    subparser.add_argument('--codec', type=str, default='avc1',
+                           help='four character code of the codec used for movies')
+    subparser.add_argument('--fps', type=int, default=30,
+                           help='frame rate of movies')
+
+
+def _add_statistics_arguments(subparser):
+    subparser.add_argument('--stats', type=str, nargs='?', const='-', metavar='FILE',
+                           help='prints how much time each stage took, or writes it to FILE as JSON')
+    subparser.add_argument('--trace-memory', action='store_true',
+                           help='also reports peak memory use with --stats, which slows things down')
+
+
+def _report_statistics(output):
+    if output == '-':
+        wif.stats.print_summary()
+    else:
+        with open(output, 'w') as file:
+            json.dump(wif.stats.summary(), file, indent=2)
+
+
+def _add_batch_arguments(subparser):
+    subparser.add_argument('input', type=str, nargs='+',
+                           help='files, glob patterns or directories to convert')
+    subparser.add_argument('output', type=str,
+                           help='output file, or for batches a directory or a pattern containing {stem}')
+    subparser.add_argument('-p', '--processes', type=int,
+                           help='number of processes converting a batch of files, 0 for one per core')
+    subparser.add_argument('--force', action='store_true',
+                           help='also converts files whose output is newer than the input')
+
+
+def _add_selection_arguments(subparser):
+    subparser.add_argument('--start', type=int, help='index of the first frame')
+    subparser.add_argument('--stop', type=int, help='index of the frame to stop at')
+    subparser.add_argument('--step', type=int, help='only takes every step-th frame')
+
+
+def _add_decoding_arguments(subparser):
+    subparser.add_argument('-w', '--workers', type=int,
+                           help='number of processes decoding frames, 0 for one per core')
+    subparser.add_argument('--frames-in-flight', type=int,
+                           help='maximum number of frames being decoded at the same time')
+
+
 def _process_command_line_arguments():
     parser = argparse.ArgumentParser()
     parser.set_defaults(func=gui)
@@ -193,42 +566,105 @@ def _process_command_line_arguments():
     subparsers = parser.add_subparsers()
 
     subparser = subparsers.add_parser('info', help='prints information about the given WIF file')
-    subparser.add_argument('input', type=str, default='STDIN', nargs='?')
+    subparser.add_argument('input', type=str, default='-', nargs='?',
+                           help='WIF file to inspect, reads stdin if left out or -')
+    subparser.add_argument('--json', action='store_true',
+                           help='prints offsets and sizes of all frames as JSON')
+    subparser.add_argument('--duplicates', action='store_true',
+                           help='counts frames identical to an earlier one, which means hashing every frame of a WIF file')
+    _add_statistics_arguments(subparser)
     subparser.set_defaults(func=info)
 
     subparser = subparsers.add_parser('gui', help='opens GUI')
     subparser.set_defaults(func=gui)
 
     subparser = subparsers.add_parser('convert', help='converts between formats')
-    subparser.add_argument('input', type=str)
-    subparser.add_argument('output', type=str)
+    _add_batch_arguments(subparser)
+    subparser.add_argument('--format', choices=['wif', 'wif2', 'mp4', 'rgb24'],
+                           help='format to convert to when the output is a directory (default mp4) '
+                                'or - for stdout (default wif), rgb24 being raw pixels as read by ffmpeg -f rawvideo')
     subparser.add_argument('-q', '--quiet', action='store_true')
-    subparser.set_defaults(func=_convert, codec='avc1')
+    subparser.add_argument('--compression', choices=wif.container.COMPRESSIONS, default='zlib',
+                           help='how frames are compressed in WIF2 output')
+    subparser.add_argument('--preview-scale', type=int, choices=wif.reading.PREVIEW_SCALES, default=1,
+                           help='shows frames this many times smaller in the gui, which saves time and memory')
+    _add_rendering_arguments(subparser)
+    _add_selection_arguments(subparser)
+    _add_decoding_arguments(subparser)
+    _add_encoding_arguments(subparser)
+    _add_statistics_arguments(subparser)
+    subparser.set_defaults(func=_convert_files, convert=_convert)
 
     subparser = subparsers.add_parser('movie', help='converts to movie')
-    subparser.add_argument('input', type=str)
-    subparser.add_argument('output', type=str)
+    _add_batch_arguments(subparser)
     subparser.add_argument('-q', '--quiet', action='store_true')
-    subparser.add_argument('--codec', type=str)
-    subparser.set_defaults(func=_convert_to_movie, codec='avc1')
+    _add_rendering_arguments(subparser)
+    _add_selection_arguments(subparser)
+    _add_decoding_arguments(subparser)
+    _add_encoding_arguments(subparser)
+    _add_statistics_arguments(subparser)
+    subparser.set_defaults(func=_convert_files, convert=_convert_to_movie, format='mp4')
 
     subparser = subparsers.add_parser('frame', help='extracts single frame')
     subparser.add_argument('input', type=str)
     subparser.add_argument('frame', type=int)
     subparser.add_argument('output', type=str)
     subparser.add_argument('-q', '--quiet', action='store_true')
+    _add_rendering_arguments(subparser)
+    _add_selection_arguments(subparser)
+    _add_statistics_arguments(subparser)
     subparser.set_defaults(func=_extract_frame)
 
+    subparser = subparsers.add_parser('frames', help='extracts frames as image files')
+    subparser.add_argument('input', type=str)
+    subparser.add_argument('output', type=str, help='directory to write images to')
+    subparser.add_argument('--pattern', type=_parse_pattern, default='frame_%05d.png',
+                           help='name of the image files, %%d being replaced by the frame index')
+    subparser.add_argument('-w', '--workers', type=int, default=0,
+                           help='number of processes writing images, 0 for one per core')
+    subparser.add_argument('--force', action='store_true',
+                           help='also writes images whose frame has not changed')
+    subparser.add_argument('-q', '--quiet', action='store_true')
+    _add_rendering_arguments(subparser)
+    _add_selection_arguments(subparser)
+    subparser.set_defaults(func=_extract_frames)
+
+    subparser = subparsers.add_parser('bench', help='measures performance on synthetic data')
+    subparser.add_argument('--benchmarks', nargs='+', choices=wif.bench.BENCHMARKS, default=list(wif.bench.BENCHMARKS))
+    subparser.add_argument('--sizes', nargs='+', default=['320x240', '1920x1080'],
+                           help='frame sizes, written as WIDTHxHEIGHT')
+    subparser.add_argument('--frame-counts', nargs='+', type=int, default=[30])
+    subparser.add_argument('--block-sizes', nargs='+', type=int, default=[wif.config.configuration['block_size']])
+    subparser.add_argument('--rate', type=int, default=0,
+                           help='frames per second written by the stub raytracer, 0 for no limit')
+    subparser.add_argument('-w', '--workers', type=int, default=1,
+                           help='number of processes decoding frames in the read_images benchmark')
+    subparser.add_argument('--codec', type=str, default='mp4v')
+    subparser.add_argument('-o', '--output', type=str, default='STDOUT',
+                           help='file to write the results to as JSON')
+    subparser.add_argument('-q', '--quiet', action='store_true')
+    subparser.set_defaults(func=_benchmark)
+
     subparser = subparsers.add_parser('config', help='configure')
     subparser.add_argument('setting', type=str, nargs='?')
     subparser.add_argument('value', type=str, nargs='?')
     subparser.set_defaults(func=_configure)
 
+    subparser = subparsers.add_parser('cache', help='inspects or clears the render cache')
+    subparser.add_argument('action', choices=['stats', 'clear'], default='stats', nargs='?')
+    subparser.set_defaults(func=_manage_cache)
+
     subparser = subparsers.add_parser('delconfig', help='delete configuration file')
     subparser.set_defaults(func=_delete_configuration_file)
 
     args = parser.parse_args()
+    statistics = getattr(args, 'stats', None)
+    if statistics:
+        # Stages only get instrumented if statistics are enabled before they are set up
+        wif.stats.enable(trace_memory=args.trace_memory)
     args.func(args)
+    if statistics:
+        _report_statistics(statistics)
 
 
 def main():
@@ -1,32 +1,448 @@
+import asyncio
+import binascii
+import contextlib
+import itertools
+import os
+import sys
 import wif.gui.imgview
 import wif.encoding
 import wif.config
 import wif.reading
 import wif.concurrency
+import wif.cache
+import wif.stats
+
+
+_block_channel_capacity = 16
+_shard_lookahead = 4
+# Limits the number of RenderJobs running at the same time, created on the background loop
+_render_slots = None
+
+
+class RaytracerFailed(Exception):
+    def __init__(self, returncode):
+        super().__init__(f'Raytracer exited with code {returncode}')
+        self.returncode = returncode
+
+
+class RenderCancelled(Exception):
+    def __init__(self):
+        super().__init__('Rendering was cancelled')
 
 
 def _raytracer_path():
     return wif.config.configuration['raytracer']
 
 
-def invoke_raytracer(script, ignore_messages=False):
-    command = [_raytracer_path()]
-    if ignore_messages:
-        command.append('--quiet')
-    command += ['-s', '-']
+class RaytracerProcess:
+    '''
+    Runs the raytracer as an asyncio subprocess.
+    The script is written to stdin while stdout and stderr are being read,
+    so that no pipe can fill up and stall the others.
+
+        async with RaytracerProcess(script) as process:
+            async for frame in process.frames():
+                ...
+    '''
+    def __init__(self, script, ignore_messages=False):
+        self.__script = script
+        self.__ignore_messages = ignore_messages
+        self.__process = None
+        self.__feeder = None
+
+    @property
+    def command(self):
+        command = [_raytracer_path()]
+        if self.__ignore_messages:
+            command.append('--quiet')
+        command += ['-s', '-']
+        return command
+
+    async def start(self):
+        self.__process = await asyncio.create_subprocess_exec(
+            *self.command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=None if self.__ignore_messages else asyncio.subprocess.PIPE)
+        self.__feeder = asyncio.ensure_future(self.__feed_script())
+
+    async def __feed_script(self):
+        try:
+            self.__process.stdin.write(self.__script.encode('ascii'))
+            await self.__process.stdin.drain()
+            self.__process.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            # The raytracer quit before reading the whole script
+            pass
+
+    async def blocks(self):
+        '''
+        Yields the raytracer's output in blocks of at most block_size bytes.
+        '''
+        block_size = wif.config.configuration['block_size']
+        while True:
+            block = await self.__process.stdout.read(block_size)
+            if not block:
+                break
+            yield block
+
+    async def payloads(self):
+        '''
+        Yields the base64 payload of each frame, without the delimiters.
+        '''
+        scanner = wif.reading.FrameScanner()
+        async for block in self.blocks():
+            for payload in scanner.feed(block):
+                yield bytes(payload)
+
+    async def frames(self):
+        scanner = wif.reading.FrameScanner()
+        async for block in self.blocks():
+            for payload in scanner.feed(block):
+                yield scanner.decode(payload)
+
+    async def messages(self):
+        '''
+        Yields the lines the raytracer writes to stderr.
+        Yields nothing if messages are ignored.
+        '''
+        if self.__process.stderr is None:
+            return
+        async for line in self.__process.stderr:
+            yield line.decode('ascii', errors='replace')
+
+    async def wait(self, timeout=None):
+        '''
+        Waits for the raytracer to exit and returns its exit code.
+        The raytracer is killed if it does not exit in time.
+        '''
+        try:
+            return await asyncio.wait_for(self.__process.wait(), timeout)
+        except asyncio.TimeoutError:
+            self.kill()
+            raise
+
+    def kill(self):
+        if self.__process and self.__process.returncode is None:
+            self.__process.kill()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            # Covers cancellation as well
+            self.kill()
+            await self.__discard_output()
+        returncode = await self.__process.wait()
+        self.__feeder.cancel()
+        if exc_type is None and returncode != 0:
+            # Keeps the output of a failed run from being taken for a complete rendering
+            raise RaytracerFailed(returncode)
+
+    async def __discard_output(self):
+        '''
+        asyncio only reports a process as finished once its pipes have been read to the end.
+        '''
+        for stream in (self.__process.stdout, self.__process.stderr):
+            if stream is not None:
+                while await stream.read(wif.config.configuration['block_size']):
+                    pass
+
+
+def _shard_prelude(shard, shards):
+    return f'global wif_frame_start = {shard};\nglobal wif_frame_step = {shards};\n'
+
+
+class ShardedRaytracer:
+    '''
+    Renders an animation with several raytracer processes.
+    Each process renders every jobs-th frame, each starting at a different frame.
+    A prelude injected in front of the script tells a process which frames are its share:
+
+        global wif_frame_start = <first frame>;
+        global wif_frame_step = <number of jobs>;
+
+    Scripts are expected to only render the frames
+    wif_frame_start, wif_frame_start + wif_frame_step, ...
+    The output of all processes is merged back into frame order as it arrives.
+    Offers the same interface as RaytracerProcess.
+    '''
+    def __init__(self, script, jobs, ignore_messages=False):
+        self.__processes = [RaytracerProcess(_shard_prelude(shard, jobs) + script, ignore_messages=ignore_messages)
+                            for shard in range(jobs)]
+        self.__stack = None
+
+    async def __aenter__(self):
+        self.__stack = contextlib.AsyncExitStack()
+        await self.__stack.__aenter__()
+        try:
+            for process in self.__processes:
+                await self.__stack.enter_async_context(process)
+        except BaseException:
+            await self.__stack.__aexit__(*sys.exc_info())
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        return await self.__stack.__aexit__(exc_type, exc_value, traceback)
+
+    def kill(self):
+        for process in self.__processes:
+            process.kill()
+
+    async def blocks(self):
+        '''
+        Yields one block per frame, in frame order.
+        Each process can run ahead of the merge by a few frames.
+        '''
+        channels = [wif.concurrency.Channel(_shard_lookahead) for _ in self.__processes]
+        readers = [asyncio.ensure_future(_forward_and_close(process.payloads(), channel))
+                   for process, channel in zip(self.__processes, channels)]
+        try:
+            for index in itertools.count():
+                try:
+                    payload = await channels[index % len(channels)].receive_async()
+                except wif.concurrency.ChannelClosed:
+                    # The process that should have rendered this frame is done, so the animation is over
+                    break
+                yield wif.reading.FRAME_START + payload + wif.reading.FRAME_END + b'\n'
+        finally:
+            for reader in readers:
+                reader.cancel()
+
+    async def frames(self):
+        async for block in self.blocks():
+            yield binascii.a2b_base64(block[len(wif.reading.FRAME_START):-len(wif.reading.FRAME_END) - 1])
+
+    async def messages(self):
+        '''
+        Yields the messages of all processes as they arrive,
+        each prefixed with the first frame of the process it came from.
+        '''
+        async for message in _interleave([_prefix(f'[{shard}] ', process.messages())
+                                          for shard, process in enumerate(self.__processes)]):
+            yield message
+
+
+async def _prefix(prefix, messages):
+    async for message in messages:
+        yield prefix + message
+
 
-    (stdout, stderr) = wif.reading.open_subprocess(
-        command,
-        script,
-        ignore_stderr=ignore_messages)
+async def _interleave(iterators):
+    '''
+    Yields the items of several async iterators as soon as they arrive.
+    '''
+    channel = wif.concurrency.Channel()
 
-    blocks = (block.decode('ascii') for block in wif.reading.read_blocks_from_stream(stdout))
-    messages = None if ignore_messages else wif.reading.read_lines_from_stream(stderr)
+    async def forward_all():
+        await asyncio.gather(*(_forward(iterator, channel) for iterator in iterators))
 
+    task = asyncio.ensure_future(_close_when_done(forward_all(), [channel]))
+    try:
+        async for item in channel:
+            yield item
+    finally:
+        task.cancel()
+
+
+async def _forward_and_close(items, channel):
+    await _close_when_done(_forward(items, channel), [channel])
+
+
+async def _close_when_done(coroutine, channels):
+    '''
+    Closes the channels once the coroutine is done, passing on its error if it failed.
+    '''
+    try:
+        await coroutine
+    except wif.concurrency.ChannelClosed:
+        # The receiver is not interested in the rest of the output
+        _close_all(channels)
+    except Exception as error:
+        _close_all(channels, error)
+    else:
+        _close_all(channels)
+
+
+def _close_all(channels, error=None):
+    for channel in channels:
+        channel.close(error)
+
+
+def create_raytracer(script, jobs=1, ignore_messages=False):
+    if jobs == 1:
+        return RaytracerProcess(script, ignore_messages=ignore_messages)
+    else:
+        return ShardedRaytracer(script, jobs, ignore_messages=ignore_messages)
+
+
+async def _forward(items, channel):
+    async for item in items:
+        await channel.send_async(item)
+
+
+async def _forward_messages(messages, channel):
+    '''
+    Keeps reading messages after the receiver has lost interest in them,
+    so that the raytracer never blocks on a full stderr pipe.
+    '''
+    async for message in messages:
+        try:
+            await channel.send_async(message)
+        except wif.concurrency.ChannelClosed:
+            pass
+
+
+def _render_slot():
+    '''
+    Returns an async context manager that waits until fewer than render_limit
+    jobs are running. A limit of 0 means there is no limit.
+    '''
+    global _render_slots
+    limit = wif.config.configuration['render_limit']
+    if not limit:
+        # Does nothing on entering and exiting
+        return contextlib.AsyncExitStack()
+    if _render_slots is None:
+        _render_slots = asyncio.Semaphore(limit)
+    return _render_slots
+
+
+async def _run_into_channels(process, blocks, messages, timeout, limited=False):
+    '''
+    Runs the raytracer, sending its output and messages to the given channels.
+    A timeout or the receiver closing the blocks channel kills the raytracer.
+    If limited, the raytracer only starts once a render slot is available.
+    Cancelling kills the raytracer and closes the channels with RenderCancelled.
+    '''
+    channels = [blocks] if messages is None else [blocks, messages]
+
+    async def run():
+        slot = _render_slot() if limited else contextlib.AsyncExitStack()
+        if isinstance(slot, asyncio.Semaphore) and messages is not None and slot.locked():
+            await messages.send_async('Waiting for other renderings to finish\n')
+        async with slot:
+            async with process:
+                tasks = [_forward(process.blocks(), blocks)]
+                if messages is not None:
+                    tasks.append(_forward_messages(process.messages(), messages))
+                await asyncio.wait_for(asyncio.gather(*tasks), timeout)
+
+    try:
+        await _close_when_done(run(), channels)
+    except asyncio.CancelledError:
+        _close_all(channels, RenderCancelled())
+        raise
+
+
+def _receive_all(channel):
+    try:
+        yield from channel
+    finally:
+        # Lets the raytracer be stopped when the receiver loses interest
+        channel.close()
+
+
+def _cache_key(script, jobs):
+    raytracer = _raytracer_path()
+    if wif.cache.is_enabled() and raytracer and os.path.isfile(raytracer):
+        return wif.cache.cache_key(script, raytracer, jobs)
+    else:
+        return None
+
+
+def invoke_raytracer(script, ignore_messages=False, timeout=None, jobs=1, use_cache=True):
+    '''
+    Starts the raytracer on the background event loop.
+    Returns generators for its output blocks and its messages.
+    Closing the blocks generator, or not exhausting it within timeout seconds,
+    kills the raytracer. With more than one job, the animation is rendered
+    by as many raytracer processes, see ShardedRaytracer.
+    Renderings are replayed from the render cache when possible.
+    '''
+    blocks, messages, _ = _invoke_raytracer(script, ignore_messages, timeout, jobs, use_cache)
     return (blocks, messages)
 
 
-def raytrace(script, ignore_messages=False):
-    blocks, messages = invoke_raytracer(script, ignore_messages=ignore_messages)
-    images = wif.reading.read_images(blocks)
+def _invoke_raytracer(script, ignore_messages, timeout, jobs, use_cache, limited=False):
+    '''
+    Like invoke_raytracer, but also returns a function that cancels the rendering.
+    '''
+    key = _cache_key(script, jobs) if use_cache else None
+    if key:
+        cached = wif.cache.replay(key, ignore_messages=ignore_messages)
+        if cached:
+            blocks, messages = cached
+            # Nothing to cancel, replays stop when their receiver loses interest
+            return (blocks, messages, lambda: None)
+
+    process = create_raytracer(script, jobs=jobs, ignore_messages=ignore_messages)
+    blocks = wif.concurrency.Channel(_block_channel_capacity)
+    messages = None if ignore_messages else wif.concurrency.Channel()
+    channels = [blocks] if messages is None else [blocks, messages]
+
+    future = wif.concurrency.run_coroutine_in_background(
+        _run_into_channels(process, blocks, messages, timeout, limited=limited))
+
+    def cancel():
+        future.cancel()
+        # The coroutine does not get to close the channels if it never started
+        _close_all(channels, RenderCancelled())
+
+    # Time spent receiving blocks is time spent waiting for the raytracer
+    blocks = wif.stats.instrument('raytracer', _receive_all(blocks), size=len)
+    messages = None if messages is None else _receive_all(messages)
+
+    if key:
+        blocks, messages = wif.cache.record(key, blocks, messages)
+    return (blocks, messages, cancel)
+
+
+def raytrace(script,
+             ignore_messages=False,
+             workers=None,
+             frames_in_flight=None,
+             timeout=None,
+             jobs=1,
+             use_cache=True,
+             duplicates=None,
+             selection=None,
+             preview_scale=1):
+    blocks, messages = invoke_raytracer(script,
+                                        ignore_messages=ignore_messages,
+                                        timeout=timeout,
+                                        jobs=jobs,
+                                        use_cache=use_cache)
+    images = wif.reading.read_images(blocks,
+                                     workers=workers,
+                                     frames_in_flight=frames_in_flight,
+                                     duplicates=duplicates,
+                                     selection=selection,
+                                     preview_scale=preview_scale)
     return (images, messages)
+
+
+class RenderJob:
+    '''
+    Renders a script into arrays of pixels, see wif.reading.read_arrays,
+    but can be cancelled from any thread. Cancelling kills the raytracer,
+    after which arrays and messages end with a RenderCancelled error. At most render_limit jobs render
+    at the same time, the others wait for their turn.
+    '''
+    def __init__(self, script, jobs=1, use_cache=True, duplicates=None, selection=None, preview_scale=1):
+        blocks, self.messages, self.__cancel = _invoke_raytracer(script,
+                                                                 ignore_messages=False,
+                                                                 timeout=None,
+                                                                 jobs=jobs,
+                                                                 use_cache=use_cache,
+                                                                 limited=True)
+        self.arrays = wif.reading.read_arrays(blocks,
+                                              duplicates=duplicates,
+                                              selection=selection,
+                                              preview_scale=preview_scale)
+
+    def cancel(self):
+        self.__cancel()
@@ -1,111 +1,889 @@
-import base64
+import binascii
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import mmap
+import os
 import struct
+import sys
+import tempfile
+import numpy
 from PIL import Image
-import re
 import subprocess
+from multiprocessing.shared_memory import SharedMemory
 from wif.config import configuration
+import wif.container
+import wif.concurrency
+import wif.stats
 
 
-def read_blocks_from_stream(stream):
+FRAME_START = b'<<<'
+FRAME_END = b'>>>'
+# Factors by which previews can be scaled down
+PREVIEW_SCALES = (1, 2, 4, 8)
+
+
+def _read_blocks(stream, read=None):
     block_size = configuration['block_size']
+    read = read or stream.read
 
     while True:
-        block = stream.read(block_size)
+        block = read(block_size)
         if not block:
             break
         yield block
 
 
+def read_blocks_from_stream(stream):
+    '''
+    Reads blocks from a stream, which is read in binary mode even if it is a text stream.
+    Blocks are yielded as soon as data is available rather than once a whole block
+    has been read, so that frames written slowly to a pipe are not held back.
+    '''
+    stream = getattr(stream, 'buffer', stream)
+    read = getattr(stream, 'read1', None)
+    return wif.stats.instrument('read', _read_blocks(stream, read), size=len)
+
+
+def read_blocks_from_stdin():
+    return read_blocks_from_stream(sys.stdin)
+
+
+def _read_blocks_from_file(path):
+    with open(path, 'rb') as stream:
+        yield from _read_blocks(stream)
+
+
 def read_blocks_from_file(path):
-    block_size = configuration['block_size']
+    return wif.stats.instrument('read', _read_blocks_from_file(path), size=len)
 
-    with open(path) as stream:
-        while True:
-            block = stream.read(block_size)
-            if not block:
-                break
-            yield block
 
+class FrameScanner:
+    '''
+    Finds frames delimited by <<< >>> in a stream of blocks.
+    Only the bytes of the frame currently being scanned are kept
+    between calls to feed, and delimiters are searched for incrementally,
+    i.e., no byte is looked at twice.
+    '''
+    def __init__(self):
+        self.__buffer = bytearray()
+        self.__offset = 0
+        self.__position = 0
+        self.__payload_start = None
+
+    @property
+    def payload_offset(self):
+        '''
+        Position in the stream of the payload that was yielded last.
+        '''
+        return self.__offset + self.__payload_start
+
+    def feed(self, block):
+        '''
+        Adds a block and yields the base64 payload of each frame it completes.
+        Payloads are memoryviews which are only valid until the next frame is requested.
+        '''
+        if isinstance(block, str):
+            block = block.encode('ascii')
+
+        self.__compact()
+        self.__buffer += block
 
-def read_frames(blocks):
+        while True:
+            if self.__payload_start is None:
+                index = self.__buffer.find(FRAME_START, self.__position)
+                if index == -1:
+                    # Keep the tail in case a delimiter straddles two blocks
+                    self.__position = max(self.__position, len(self.__buffer) - len(FRAME_START) + 1)
+                    return
+                self.__payload_start = self.__position = index + len(FRAME_START)
+
+            index = self.__buffer.find(FRAME_END, self.__position)
+            if index == -1:
+                self.__position = max(self.__position, len(self.__buffer) - len(FRAME_END) + 1)
+                return
+
+            with memoryview(self.__buffer) as view, view[self.__payload_start:index] as payload:
+                if not _is_end_marker(payload):
+                    yield payload
+
+            self.__position = index + len(FRAME_END)
+            self.__payload_start = None
+
+    def __compact(self):
+        '''
+        Drops everything before the frame currently being scanned.
+        '''
+        discard = self.__position if self.__payload_start is None else self.__payload_start
+        del self.__buffer[:discard]
+        self.__offset += discard
+        self.__position -= discard
+        if self.__payload_start is not None:
+            self.__payload_start -= discard
+
+    @staticmethod
+    def scan(buffer):
+        '''
+        Yields (offset, payload) for each frame in a buffer holding a whole stream,
+        e.g., a memory mapped file. Payloads are views on the buffer.
+        '''
+        position = 0
+
+        with memoryview(buffer) as view:
+            while True:
+                start = buffer.find(FRAME_START, position)
+                if start == -1:
+                    return
+                start += len(FRAME_START)
+                end = buffer.find(FRAME_END, start)
+                if end == -1:
+                    return
+
+                with view[start:end] as payload:
+                    if not _is_end_marker(payload):
+                        yield (start, payload)
+
+                position = end + len(FRAME_END)
+
+    decode = staticmethod(binascii.a2b_base64)
+
+    @staticmethod
+    def decoded_size(payload):
+        # Base64 encodes 3 bytes in 4 characters
+        return len(payload) // 4 * 3
+
+    @staticmethod
+    def describe(payload):
+        return _describe_payload(len(payload), payload, payload)
+
+
+def _create_scanner(block):
     '''
-    Finds blocks delimited by <<< >>>
+    Picks the scanner for a stream based on its first block.
     '''
-    regex = re.compile(r'\s*<<<(.*?)>>>\s*(.*)', re.MULTILINE | re.DOTALL)
-    buffer = ''
+    if not isinstance(block, str) and wif.container.is_container(block):
+        return wif.container.RecordScanner()
+    else:
+        return FrameScanner()
+
+
+def _scan_blocks(blocks):
+    scanner = None
+    # Blocks read from pipes can be shorter than the magic number WIF2 streams start with
+    head = b''
 
     for block in blocks:
-        buffer += block
-        match = re.match(regex, buffer)
+        if scanner is None and not isinstance(block, str):
+            head += block
+            if len(head) < len(wif.container.MAGIC):
+                continue
+            block = head
+        if scanner is None:
+            scanner = _create_scanner(block)
+        for payload in scanner.feed(block):
+            yield (scanner, scanner.payload_offset, payload)
+
+    if scanner is None and head:
+        scanner = _create_scanner(head)
+        for payload in scanner.feed(head):
+            yield (scanner, scanner.payload_offset, payload)
+
+
+def _scan(blocks, selection=None, resolve_references=False):
+    '''
+    Yields (scanner, offset, payload) for each frame, where the scanner
+    suits the format of the stream, which can be either WIF or WIF2.
+    Only the frames picked by the selection, a slice, are yielded.
+    With resolve_references, duplicates stored as a reference in WIF2 streams
+    are yielded as the record they refer to instead of as a FrameReference.
+    '''
+    scanned = wif.stats.instrument('scan', _scan_blocks(blocks), size=_scanned_size)
+    if selection is None and not resolve_references:
+        return scanned
+    scanned = _set_records_aside(scanned, selection, resolve_references)
+    # Frames are skipped before they get decoded
+    return scanned if selection is None else select(scanned, selection)
+
+
+def _scanned_size(scanned):
+    _, _, payload = scanned
+    return 0 if isinstance(payload, FrameReference) else len(payload)
+
+
+def _is_mappable(path):
+    return os.path.isfile(path) and os.path.getsize(path) > 0
+
+
+@contextlib.contextmanager
+def _map_file(path):
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+        yield mapping
+
+
+def _scan_mapped_file(path):
+    with _map_file(path) as mapping:
+        scanner = _create_scanner(mapping[:len(wif.container.MAGIC)])
+        payloads = scanner.scan(mapping)
+        try:
+            for offset, payload in payloads:
+                yield (scanner, offset, payload)
+        finally:
+            # Views on the mapping must be released before it can be closed
+            payloads.close()
+
+
+def _scan_file(path, selection=None, resolve_references=False):
+    '''
+    Like _scan, but for files. Regular files are memory mapped
+    and payloads are views on the mapping, so that no data gets copied
+    and reopening a file is served from the OS page cache.
+    '''
+    if not _is_mappable(path):
+        return _scan(read_blocks_from_file(path), selection, resolve_references)
+    scanned = wif.stats.instrument('scan', _scan_mapped_file(path), size=_scanned_size)
+    # References in WIF2 files are replaced by their record while scanning, so skipped frames are not kept
+    return scanned if selection is None else select(scanned, selection)
+
+
+def select(items, selection):
+    '''
+    Yields the items picked by a slice, e.g., slice(1000, 1200) or slice(None, None, 10).
+    Items are only pulled until the end of the slice has been reached.
+    Negative values are not supported, as the number of items is not known in advance.
+    '''
+    start = selection.start or 0
+    stop = selection.stop
+    step = selection.step or 1
+    if start < 0 or (stop is not None and stop < 0) or step < 1:
+        raise ValueError('Frame selections cannot be negative')
+
+    iterator = iter(items)
+    try:
+        for index, item in enumerate(iterator):
+            if stop is not None and index >= stop:
+                return
+            if index >= start and (index - start) % step == 0:
+                yield item
+    finally:
+        # Lets the producer know the remaining items are not needed
+        close = getattr(iterator, 'close', None)
+        if close:
+            close()
+
+
+def _is_selected(index, selection):
+    if selection is None:
+        return True
+    start = selection.start or 0
+    step = selection.step or 1
+    return index >= start and (selection.stop is None or index < selection.stop) and (index - start) % step == 0
+
+
+def _set_records_aside(scanned, selection, resolve_references):
+    '''
+    FrameReferences found in WIF2 streams refer to the index of a frame in the stream,
+    which is turned into its index among the selected frames.
+    A stream cannot be rewound, so the records a FrameReference may need to be replaced by
+    are set aside in a temporary file: those of skipped frames, or all of them with resolve_references.
+    Records are kept as they are found in the stream, i.e., compressed, and never in memory.
+    Text WIF streams hold no references and are passed through as they are.
+    '''
+    # Maps the index of each frame in the stream to its index among the selected frames
+    positions = {}
+    # Maps the index of each frame set aside to where its record is found in the temporary file
+    records = {}
+    position = 0
+    iterator = iter(scanned)
+    with contextlib.ExitStack() as stack:
+        spill = None
+        try:
+            for index, (scanner, offset, payload) in enumerate(iterator):
+                selected = _is_selected(index, selection)
+                if isinstance(payload, FrameReference):
+                    reference = payload
+                    if reference.index in positions:
+                        payload = FrameReference(positions[reference.index])
+                    elif selected:
+                        start, size = records[reference.index]
+                        spill.seek(start)
+                        payload = spill.read(size)
+                        if not resolve_references:
+                            # Later references can refer to this copy
+                            positions[reference.index] = position
+                elif isinstance(scanner, wif.container.RecordScanner):
+                    if selected and not resolve_references:
+                        positions[index] = position
+                    else:
+                        if spill is None:
+                            spill = stack.enter_context(tempfile.TemporaryFile())
+                        spill.seek(0, os.SEEK_END)
+                        records[index] = (spill.tell(), spill.write(payload))
+                if selected:
+                    position += 1
+                yield (scanner, offset, payload)
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close:
+                close()
+
+
+FrameReference = collections.namedtuple('FrameReference', ['index'])
+FrameReference.__doc__ = '''
+Stands in for a frame that is identical to the earlier frame with the given index.
+They are produced by a DuplicateDetector, and by scanning WIF2 streams,
+which store duplicate frames as a reference to the original.
+'''
+
+
+class DuplicateDetector:
+    '''
+    Recognizes frames that are identical to an earlier one by hashing their payloads,
+    so that they need not be decoded, converted or stored again.
+    Only the last history distinct frames are remembered, or all of them if history is None.
+    '''
+    def __init__(self, history=None):
+        self.__history = history
+        self.__indices = collections.OrderedDict()
+        self.__frame_count = 0
+        self.__duplicate_count = 0
+
+    @property
+    def frame_count(self):
+        return self.__frame_count
+
+    @property
+    def duplicate_count(self):
+        return self.__duplicate_count
+
+    def check(self, payload):
+        '''
+        Returns the index of the earlier frame the payload is identical to, or None.
+        '''
+        digest = hashlib.blake2b(payload, digest_size=16).digest()
+        index = self.__frame_count
+        self.__frame_count += 1
+
+        original = self.__indices.get(digest)
+        if original is not None:
+            self.__indices.move_to_end(digest)
+            self.__duplicate_count += 1
+            return original
+
+        self.__indices[digest] = index
+        if self.__history is not None and len(self.__indices) > self.__history:
+            self.__indices.popitem(last=False)
+        return None
+
+    def check_reference(self, index):
+        '''
+        Counts a frame the stream itself marks as identical to the frame with the given index.
+        '''
+        self.__frame_count += 1
+        self.__duplicate_count += 1
+        return index
+
+
+def _deduplicate(scanned, duplicates):
+    '''
+    Replaces the payloads of duplicate frames by a FrameReference.
+    '''
+    if duplicates is None:
+        yield from scanned
+        return
+
+    for scanner, offset, payload in scanned:
+        if isinstance(payload, FrameReference):
+            duplicates.check_reference(payload.index)
+            yield (scanner, offset, payload)
+        else:
+            original = duplicates.check(payload)
+            yield (scanner, offset, payload if original is None else FrameReference(original))
+
+
+def _decoder(scanner):
+    return wif.stats.instrument_function('decode', scanner.decode, size=len)
+
+
+def _decode_frames(scanned, duplicates):
+    for scanner, _, payload in _deduplicate(scanned, duplicates):
+        if isinstance(payload, FrameReference):
+            yield payload
+        else:
+            # Decode straight from the scanner's buffer
+            yield _decoder(scanner)(payload)
+
+
+def read_frames(blocks, duplicates=None, selection=None, resolve_references=False):
+    '''
+    Finds blocks delimited by <<< >>>, or frame records in WIF2 streams.
+    Given a DuplicateDetector, frames identical to an earlier one
+    are yielded as a FrameReference instead. Duplicates stored as such
+    in WIF2 streams are also yielded as a FrameReference, unless resolve_references is set
+    for consumers that need every frame in full.
+    Given a selection, a slice, only the frames it picks are decoded.
+    '''
+    return _decode_frames(_scan(blocks, selection, resolve_references), duplicates)
+
+
+def read_frames_from_file(path, duplicates=None, selection=None, resolve_references=False):
+    return _decode_frames(_scan_file(path, selection, resolve_references), duplicates)
+
+
+def _is_end_marker(payload):
+    '''
+    The raytracer ends its output with a 4 byte frame.
+    Actual frames are at least 8 bytes long, i.e., take at least 12 base64 characters.
+    '''
+    return len(payload) <= 8 and len(binascii.a2b_base64(payload)) == 4
+
+
+FrameInfo = collections.namedtuple('FrameInfo', ['offset', 'payload_size', 'size', 'width', 'height', 'duplicate_of'],
+                                   defaults=[None])
+
+
+def _describe_payload(payload_size, head, tail):
+    '''
+    Describes a frame without decoding its pixels: the header is found
+    in the first 12 base64 characters of the payload and the size of the frame
+    follows from the payload's size and padding, found in its last 2 characters.
+    Returns (payload size, frame size, width, height).
+    '''
+    width, height = _frame_size(binascii.a2b_base64(head[:12]))
+    size = payload_size // 4 * 3 - bytes(tail[-2:]).count(b'=')
+    return (payload_size, size, width, height)
+
+
+def _describe_frames(scanned, duplicates):
+    infos = []
+    for scanner, offset, payload in scanned:
+        if isinstance(payload, FrameReference):
+            if duplicates is not None:
+                duplicates.check_reference(payload.index)
+            # The frame is described by the original, the rest by the reference itself
+            info = infos[payload.index]._replace(offset=offset,
+                                                 payload_size=wif.container.TARGET.size,
+                                                 duplicate_of=payload.index)
+        else:
+            # WIF2 streams mark duplicates themselves, so there is no need to hash their frames
+            hash = duplicates is not None and not isinstance(scanner, wif.container.RecordScanner)
+            original = duplicates.check(payload) if hash else None
+            info = FrameInfo(offset, *scanner.describe(payload), duplicate_of=original)
+        infos.append(info)
+        yield info
+
+
+def read_frame_infos(blocks, duplicates=None):
+    '''
+    Yields a FrameInfo for each frame, without decoding any pixel data.
+    Given a DuplicateDetector, duplicate_of tells which earlier frame a frame is identical to.
+    WIF2 streams store duplicates as references, for which duplicate_of is always set.
+    '''
+    return _describe_frames(_scan(blocks), duplicates)
+
+
+def read_frame_infos_from_file(path, duplicates=None):
+    return _describe_frames(_scan_file(path), duplicates)
+
+
+def _index_path(path):
+    return f'{path}.idx'
+
 
-        while match:
-            frame = match.group(1)
-            buffer = match.group(2)
+def build_frame_index(path):
+    '''
+    Returns the (start, end) positions of the payload of each frame in a WIF file.
+    '''
+    return [(start, start + len(payload)) for _, start, payload in _scan_file(path)]
 
-            # Decode base64
-            decoded = base64.b64decode(frame)
 
-            if len(decoded) == 4:
-                break
+def load_frame_index(path):
+    '''
+    Returns the frame index of a WIF file.
+    The index is cached in a sidecar file which is rebuilt
+    whenever the WIF file's size or modification time changes.
+    '''
+    status = os.stat(path)
+    signature = {'size': status.st_size, 'mtime': status.st_mtime_ns}
+
+    try:
+        with open(_index_path(path)) as file:
+            data = json.load(file)
+        if data['signature'] == signature:
+            return [tuple(entry) for entry in data['frames']]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    index = build_frame_index(path)
+    try:
+        with open(_index_path(path), 'w') as file:
+            json.dump({'signature': signature, 'frames': index}, file)
+    except OSError:
+        # Not being able to cache the index is no reason to fail
+        pass
+    return index
+
+
+class WifFile:
+    '''
+    Gives random access to the frames of a WIF or WIF2 file.
+    Only the frames that are asked for are decoded,
+    straight from a memory mapping of the file.
+    '''
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self.__scanner = _create_scanner(file.read(len(wif.container.MAGIC)))
+            if isinstance(self.__scanner, FrameScanner):
+                self.__index = wif.stats.instrument_function('index', load_frame_index)(path)
             else:
-                yield decoded
+                # WIF2 files carry their own index
+                read_index = wif.stats.instrument_function('index', wif.container.read_index)
+                self.__index = read_index(file) or build_frame_index(path)
+            # Empty files cannot be mapped
+            self.__mapping = _is_mappable(path) and mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.__view = memoryview(self.__mapping or b'')
+        # Maps the offset of each frame to its index, to look up what references refer to
+        self.__frame_indices = None
+
+    def __len__(self):
+        return len(self.__index)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.__read_frame(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('frame index out of range')
+        return self.__read_frame(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.__read_frame(index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.__view.release()
+        if self.__mapping:
+            self.__mapping.close()
+
+    def frame_info(self, index):
+        '''
+        Returns the FrameInfo of a frame without decoding its pixels.
+        For WIF files, only the first and last few bytes of the frame are looked at.
+        For WIF2 files, duplicate_of is set for frames stored as a reference,
+        whose offset and payload size are those of the reference itself.
+        '''
+        start, end = self.__index[index]
+        with self.__payload(index) as payload:
+            if isinstance(self.__scanner, FrameScanner):
+                description = _describe_payload(len(payload), payload[:12], payload[-2:])
+            else:
+                description = self.__scanner.describe(payload)
+        info = FrameInfo(start, *description, duplicate_of=self.__original(index))
+        if info.duplicate_of is not None:
+            info = info._replace(payload_size=end - start - wif.container.RECORD.size)
+        return info
+
+    def __original(self, index):
+        if isinstance(self.__scanner, FrameScanner):
+            return None
+        start, end = self.__index[index]
+        target, _ = wif.container.locate_record(self.__view, start, end)
+        if target == start:
+            return None
+        if self.__frame_indices is None:
+            self.__frame_indices = {start: index for index, (start, _) in enumerate(self.__index)}
+        return self.__frame_indices[target]
+
+    def __payload(self, index):
+        start, end = self.__index[index]
+        if not isinstance(self.__scanner, FrameScanner):
+            # Duplicate frames refer to the record of the original
+            start, end = wif.container.locate_record(self.__view, start, end)
+        return self.__view[start:end]
+
+    def __read_frame(self, index):
+        with self.__payload(index) as payload:
+            return _decoder(self.__scanner)(payload)
+
+
+def _frame_size(frame):
+    # Read two little endian 32 bit integers
+    return struct.unpack_from('<2I', frame)
 
-            match = re.match(regex, buffer)
+
+def _frame_pixels(frame):
+    '''
+    Returns a view on the pixel data of a frame, without copying it.
+    '''
+    return memoryview(frame)[8:]
 
 
 def frame_to_linear_rgb(frame):
     """
     Converts a frame to a list of (R, G, B) triples.
+    frame_to_array is much faster and takes far less memory.
     """
-    # Read groups of 3 unsigned chars
-    pixels = list(struct.iter_unpack("3B", frame[8:]))
+    pixels = _frame_pixels(frame)
 
-    return pixels
+    # Group channels into triples in one pass over the buffer
+    return list(zip(pixels[0::3], pixels[1::3], pixels[2::3]))
 
 
 def frame_to_rgb(frame):
     """
     Converts a frame to a 2D list of (R, G, B) triples.
+    frame_to_array is much faster and takes far less memory.
     """
-    # Read two little endian 32 bit integers
-    width, height = struct.unpack('<2I', frame[:8])
-
-    # Read groups of 3 unsigned chars
-    pixels = list(struct.iter_unpack("3B", frame[8:]))
+    width, height = _frame_size(frame)
+    pixels = frame_to_linear_rgb(frame)
 
     return [pixels[width*j:width*(j+1)] for j in range(height)]
 
 
+def frame_to_array(frame):
+    '''
+    Takes frame data and turns it into a height x width x 3 array.
+    The array shares its memory with the frame.
+    '''
+    width, height = _frame_size(frame)
+    pixels = numpy.frombuffer(frame, dtype=numpy.uint8, count=width * height * 3, offset=8)
+    return pixels.reshape((height, width, 3))
+
+
 def frame_to_image(frame):
     '''
     Takes frame data and turns it into an image.
     '''
-    # Read two little endian 32 bit integers
-    width, height = struct.unpack('<2I', frame[:8])
+    width, height = _frame_size(frame)
+
+    # Let PIL copy the pixel data in one go
+    return Image.frombytes('RGB', (width, height), _frame_pixels(frame)[:width * height * 3])
+
+
+def frame_to_preview(frame, scale, box_filter=True):
+    '''
+    Takes frame data and turns it into an image that is scale times smaller
+    in both directions, without copying the frame into a full size image first.
+    The box filter averages each scale x scale block of pixels. Without it,
+    only the top left pixel of each block is kept, which is faster but causes aliasing.
+    '''
+    if scale < 1:
+        raise ValueError(f'Invalid preview scale {scale}')
+    if scale == 1:
+        return frame_to_image(frame)
+
+    pixels = frame_to_array(frame)
+    height, width, _ = pixels.shape
+    # Frames smaller than a block would lose all their pixels to the box filter
+    if box_filter and height >= scale and width >= scale:
+        # The array shares its memory with the frame, only the reduced array gets allocated.
+        # Rows and columns that do not make up a whole block are left out.
+        height -= height % scale
+        width -= width % scale
+        blocks = pixels[:height, :width].reshape(height // scale, scale, width // scale, scale, 3)
+        return Image.fromarray(blocks.mean(axis=(1, 3)).round().astype(numpy.uint8))
+    else:
+        return Image.fromarray(numpy.ascontiguousarray(pixels[::scale, ::scale]))
 
-    # Read groups of 3 unsigned chars
-    pixels = list(struct.iter_unpack("3B", frame[8:]))
 
-    # Create image
-    image = Image.new('RGB', (width, height))
+def _image_converter(preview_scale):
+    if preview_scale == 1:
+        return frame_to_image
+    return lambda frame: frame_to_preview(frame, preview_scale)
 
-    # Get pixel buffer
-    image_buffer = image.load()
 
-    # Write pixels to buffer
-    for y in range(height):
-        for x in range(width):
-            i = y * width + x
-            image_buffer[x, y] = pixels[i]
+def _array_converter(preview_scale, copy):
+    '''
+    Returns a function turning a frame into an array.
+    Unless copy is set, arrays of full size frames share their memory with the frame.
+    '''
+    if preview_scale != 1:
+        return lambda frame: numpy.asarray(frame_to_preview(frame, preview_scale))
+    elif copy:
+        return lambda frame: frame_to_array(frame).copy()
+    else:
+        return frame_to_array
+
+
+def _convert_frames(scanned, workers, frames_in_flight, duplicates, convert):
+    '''
+    Decodes frames, serially or in parallel depending on workers, and passes them to convert.
+    '''
+    if workers is None:
+        workers = configuration['workers']
+    scanned = _deduplicate(scanned, duplicates)
+    if workers == 1:
+        for scanner, _, payload in scanned:
+            if isinstance(payload, FrameReference):
+                yield payload
+            else:
+                yield convert(_decoder(scanner)(payload))
+    else:
+        yield from _decode_in_parallel(scanned,
+                                       workers=workers,
+                                       frames_in_flight=frames_in_flight,
+                                       convert=convert)
+
+
+def _read_images(scanned, workers, frames_in_flight, duplicates, preview_scale=1):
+    to_image = wif.stats.instrument_function('frame_to_image', _image_converter(preview_scale))
+    return _convert_frames(scanned, workers, frames_in_flight, duplicates, to_image)
+
+
+def _read_arrays(scanned, workers, frames_in_flight, duplicates, preview_scale=1):
+    if workers is None:
+        workers = configuration['workers']
+    # Frames decoded in parallel only live in shared memory for the duration of the conversion
+    to_array = _array_converter(preview_scale, copy=workers != 1)
+    return _convert_frames(scanned, workers, frames_in_flight, duplicates, to_array)
+
+
+def read_arrays(blocks,
+                workers=None,
+                frames_in_flight=None,
+                duplicates=None,
+                selection=None,
+                preview_scale=1,
+                resolve_references=False):
+    '''
+    Turns blocks into height x width x 3 arrays of RGB pixels.
+    When decoding serially, each array shares its memory with the decoded frame,
+    which makes it read-only. Takes the same arguments as read_images,
+    and resolve_references, see read_frames.
+    '''
+    scanned = _scan(blocks, selection, resolve_references)
+    return _read_arrays(scanned, workers, frames_in_flight, duplicates, preview_scale)
+
+
+def read_arrays_from_file(path,
+                          workers=None,
+                          frames_in_flight=None,
+                          duplicates=None,
+                          selection=None,
+                          preview_scale=1,
+                          resolve_references=False):
+    scanned = _scan_file(path, selection, resolve_references)
+    return _read_arrays(scanned, workers, frames_in_flight, duplicates, preview_scale)
+
+
+def read_images(blocks, workers=None, frames_in_flight=None, duplicates=None, selection=None, preview_scale=1):
+    '''
+    Turns blocks into images. With more than one worker,
+    frames are decoded in parallel by a pool of processes.
+    Given a DuplicateDetector, duplicate frames are yielded as a FrameReference.
+    Given a selection, a slice, only the frames it picks are decoded.
+    A preview_scale other than 1 yields downscaled previews, see frame_to_preview.
+    '''
+    return _read_images(_scan(blocks, selection), workers, frames_in_flight, duplicates, preview_scale)
+
 
-    # Return image
-    return image
+def read_images_from_file(path,
+                          workers=None,
+                          frames_in_flight=None,
+                          duplicates=None,
+                          selection=None,
+                          preview_scale=1):
+    return _read_images(_scan_file(path, selection), workers, frames_in_flight, duplicates, preview_scale)
 
 
-def read_images(blocks):
-    for frame in read_frames(blocks):
-        image = frame_to_image(frame)
-        yield image
+def _decode_in_shared_memory(decode, payload_name, payload_size, frame_name):
+    '''
+    Runs in a worker process: decodes the payload in one shared memory block
+    into another and returns the size of the frame.
+    '''
+    payload_memory = SharedMemory(payload_name)
+    frame_memory = SharedMemory(frame_name)
+    try:
+        with payload_memory.buf[:payload_size] as payload:
+            frame = decode(payload)
+        frame_memory.buf[:len(frame)] = frame
+        return len(frame)
+    finally:
+        payload_memory.close()
+        frame_memory.close()
+
+
+class _ParallelDecoding:
+    '''
+    A frame being decoded by a worker process, together with
+    the shared memory holding its payload and the decoded result.
+    '''
+    def __init__(self, executor, scanner, payload):
+        size = len(payload)
+        self.__payload_memory = SharedMemory(create=True, size=size)
+        self.__payload_memory.buf[:size] = payload
+        self.__frame_memory = SharedMemory(create=True, size=scanner.decoded_size(payload))
+        self.__future = executor.submit(_decode_in_shared_memory,
+                                        scanner.decode,
+                                        self.__payload_memory.name,
+                                        size,
+                                        self.__frame_memory.name)
+
+    def result(self, convert):
+        try:
+            size = self.__future.result()
+            with self.__frame_memory.buf[:size] as frame:
+                return convert(frame)
+        finally:
+            self.release()
+
+    def release(self):
+        self.__future.cancel()
+        for memory in (self.__payload_memory, self.__frame_memory):
+            memory.close()
+            memory.unlink()
+
+
+def read_frames_in_parallel(blocks, workers=0, frames_in_flight=0, convert=bytes, duplicates=None, selection=None):
+    '''
+    Decodes frames using a pool of worker processes. Payloads and decoded frames
+    are passed through shared memory instead of being pickled.
+    Frames are yielded in order, after being passed to convert, which receives
+    a memoryview that is only valid for the duration of the call.
+    At most frames_in_flight frames are being decoded at any time.
+    A value of 0 for workers means one worker per core.
+    Duplicate frames are not decoded but yielded as a FrameReference.
+    '''
+    scanned = _deduplicate(_scan(blocks, selection), duplicates)
+    return _decode_in_parallel(scanned, workers, frames_in_flight, convert)
+
+
+def _decode_in_parallel(scanned, workers, frames_in_flight, convert):
+    workers = workers or os.cpu_count()
+    frames_in_flight = frames_in_flight or configuration['frames_in_flight'] or 2 * workers
+    pending = collections.deque()
+    result = wif.stats.instrument_function('decode', _result)
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        try:
+            for scanner, _, payload in scanned:
+                if isinstance(payload, FrameReference):
+                    pending.append(payload)
+                else:
+                    pending.append(_ParallelDecoding(executor, scanner, payload))
+                if len(pending) >= frames_in_flight:
+                    yield result(pending.popleft(), convert)
+            while pending:
+                yield result(pending.popleft(), convert)
+        finally:
+            for decoding in pending:
+                if isinstance(decoding, _ParallelDecoding):
+                    decoding.release()
+
+
+def _result(decoding, convert):
+    if isinstance(decoding, FrameReference):
+        return decoding
+    else:
+        return decoding.result(convert)
 
 
 def read_lines_from_stream(stream):
@@ -125,8 +903,15 @@ def open_subprocess(command, input, ignore_stderr=False):
         stdout=subprocess.PIPE,
         stderr=None if ignore_stderr else subprocess.PIPE)
 
-    process.stdin.write(input.encode('ascii'))
-    process.stdin.close()
+    def write_input():
+        try:
+            process.stdin.write(input.encode('ascii'))
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    # Writing all input before reading any output deadlocks once the pipes are full
+    wif.concurrency.run_in_background(write_input, daemon=True)
 
     if ignore_stderr:
         return (process.stdout, None)
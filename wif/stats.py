@@ -0,0 +1,150 @@
+'''
+Keeps track of where the pipeline spends its time.
+
+Stages of the pipeline wrap their iterators and functions with instrument
+and instrument_function, which return them untouched unless statistics
+have been enabled, so that they cost nothing otherwise. Statistics must
+therefore be enabled before the pipeline is set up.
+
+Stages pull their input from earlier stages, so the time spent in a stage
+excludes the time spent in the stages it calls on the same thread.
+'''
+from threading import Lock, local
+import sys
+import time
+import tracemalloc
+
+
+_enabled = False
+_stages = {}
+_lock = Lock()
+_active = local()
+
+
+class _Stage:
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.size = 0
+        self.seconds = 0.0
+
+
+def enable(trace_memory=False):
+    '''
+    Starts collecting statistics. With trace_memory, the peak memory
+    allocated by Python is tracked too, which slows everything down.
+    '''
+    global _enabled
+    _enabled = True
+    _stages.clear()
+    if trace_memory:
+        tracemalloc.start()
+
+
+def is_enabled():
+    return _enabled
+
+
+def _stack():
+    if not hasattr(_active, 'stack'):
+        _active.stack = []
+    return _active.stack
+
+
+def _enter():
+    _stack().append([time.perf_counter(), 0.0])
+
+
+def _leave(name, size, counted=True):
+    end = time.perf_counter()
+    stack = _stack()
+    start, nested = stack.pop()
+    elapsed = end - start
+    if stack:
+        stack[-1][1] += elapsed
+    with _lock:
+        stage = _stages.get(name)
+        if stage is None:
+            stage = _stages[name] = _Stage(name)
+        stage.count += counted
+        stage.size += size
+        stage.seconds += elapsed - nested
+
+
+def _instrument(name, iterable, size):
+    iterator = iter(iterable)
+    try:
+        while True:
+            _enter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                _leave(name, 0, counted=False)
+                return
+            except BaseException:
+                _leave(name, 0, counted=False)
+                raise
+            _leave(name, size(item) if size else 0)
+            yield item
+    finally:
+        # Passes on the consumer losing interest
+        close = getattr(iterator, 'close', None)
+        if close:
+            close()
+
+
+def instrument(name, iterable, size=None):
+    '''
+    Records the time it takes to produce each item as the stage with the given name.
+    size returns the number of bytes of an item.
+    '''
+    if not _enabled:
+        return iterable
+    return _instrument(name, iterable, size)
+
+
+def instrument_function(name, function, size=None):
+    '''
+    Records the time each call to function takes as the stage with the given name.
+    size returns the number of bytes of a result.
+    '''
+    if not _enabled:
+        return function
+
+    def instrumented(*args, **kwargs):
+        _enter()
+        result = None
+        try:
+            result = function(*args, **kwargs)
+            return result
+        finally:
+            _leave(name, size(result) if size and result is not None else 0)
+
+    return instrumented
+
+
+def summary():
+    '''
+    Returns the statistics of all stages, in the order they were first used.
+    '''
+    with _lock:
+        stages = [{'stage': stage.name,
+                   'count': stage.count,
+                   'bytes': stage.size,
+                   'seconds': stage.seconds}
+                  for stage in _stages.values()]
+    result = {'stages': stages}
+    if tracemalloc.is_tracing():
+        result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+    return result
+
+
+def print_summary(file=sys.stderr):
+    statistics = summary()
+    print(f'{"stage":20} {"count":>8} {"MB":>10} {"seconds":>10} {"MB/s":>10}', file=file)
+    for stage in statistics['stages']:
+        megabytes = stage['bytes'] / 1e6
+        speed = f'{megabytes / stage["seconds"]:10.1f}' if stage['seconds'] and stage['bytes'] else f'{"":10}'
+        print(f'{stage["stage"]:20} {stage["count"]:8} {megabytes:10.1f} {stage["seconds"]:10.3f} {speed}', file=file)
+    if 'peak_memory' in statistics:
+        print(f'Peak memory allocated by Python: {statistics["peak_memory"] / 1e6:.1f} MB', file=file)
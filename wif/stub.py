@@ -0,0 +1,90 @@
+'''
+Stand-in for the raytracer, for testing wif without rendering anything.
+Point the configuration at it with
+
+    $ wif config raytracer $(which wif-stub-raytracer)
+
+Like the raytracer, it reads a script from stdin and writes frames to stdout
+and progress messages to stderr. Instead of being interpreted, the script
+is searched for assignments to the following variables:
+
+    stub_frame_count   number of frames in the animation (default 10)
+    stub_width         width of each frame (default 64)
+    stub_height        height of each frame (default 48)
+    wif_frame_start    first frame to render (default 0)
+    wif_frame_step     renders every wif_frame_step-th frame (default 1)
+    stub_frame_rate    maximum number of frames written per second, 0 for no limit (default 0)
+
+Frame i is filled with the color (i % 256, i // 256 % 256, 128),
+which makes it easy to check that frames arrive in the right order.
+'''
+import argparse
+import base64
+import os
+import re
+import struct
+import sys
+import time
+
+
+_defaults = {
+    'stub_frame_count': 10,
+    'stub_width': 64,
+    'stub_height': 48,
+    'wif_frame_start': 0,
+    'wif_frame_step': 1,
+    'stub_frame_rate': 0,
+}
+
+
+def parse_settings(script):
+    settings = dict(_defaults)
+    for name, value in re.findall(r'\b(\w+)\s*=\s*(\d+)', script):
+        if name in settings:
+            settings[name] = int(value)
+    return settings
+
+
+def create_frame(index, width, height):
+    color = bytes([index % 256, index // 256 % 256, 128])
+    return struct.pack('<2I', width, height) + color * (width * height)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--quiet', action='store_true')
+    parser.add_argument('-s', '--script', type=str, default='-')
+    args = parser.parse_args()
+
+    if args.script == '-':
+        script = sys.stdin.read()
+    else:
+        with open(args.script) as file:
+            script = file.read()
+    settings = parse_settings(script)
+    rate = settings['stub_frame_rate']
+    start = time.monotonic()
+
+    frames = range(settings['wif_frame_start'], settings['stub_frame_count'], settings['wif_frame_step'])
+    try:
+        for count, index in enumerate(frames):
+            if rate > 0:
+                # Pretend rendering takes time
+                time.sleep(max(0, start + count / rate - time.monotonic()))
+            if not args.quiet:
+                print(f'Rendering frame {index}', file=sys.stderr, flush=True)
+            frame = create_frame(index, settings['stub_width'], settings['stub_height'])
+            sys.stdout.buffer.write(b'<<<' + base64.b64encode(frame) + b'>>>\n')
+            sys.stdout.buffer.flush()
+
+        # The raytracer ends its output with a 4 byte frame
+        sys.stdout.buffer.write(b'<<<' + base64.b64encode(b'\0' * 4) + b'>>>\n')
+        sys.stdout.buffer.flush()
+    except BrokenPipeError:
+        # Whoever was reading the frames quit early, which is not an error.
+        # Keeps Python from complaining when it flushes stdout on exit.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+
+if __name__ == '__main__':
+    main()